@@ -0,0 +1,289 @@
+import asyncio
+import collections
+import logging
+import random
+import time
+
+import aiohttp
+from yarl import URL
+
+# Повторять можно только запросы, не создающие новых записей
+IDEMPOTENT_METHODS = frozenset(('GET', 'HEAD', 'PUT', 'DELETE', 'OPTIONS'))
+RETRY_STATUSES = frozenset((429, 500, 502, 503, 504))
+# Сколько последних задержек эндпоинта учитывать при расчете p95 для дублирования
+LATENCY_WINDOW = 200
+
+
+class BackendError(Exception):
+    """API robogpt.me недоступно или не отвечает."""
+
+
+class CircuitOpenError(BackendError):
+    """Запрос не отправлен: предохранитель эндпоинта разомкнут."""
+
+
+class BackendBusyError(BackendError):
+    """Запрос не отправлен: слишком много одновременных запросов к эндпоинту."""
+
+
+class CircuitBreaker:
+    """Предохранитель: после failure_threshold ошибок подряд запросы не отправляются
+    reset_timeout секунд, затем пропускается один пробный запрос."""
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, name, failure_threshold=5, reset_timeout=30):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self._probe_in_flight = False
+
+    def allow(self):
+        if self.state == self.CLOSED:
+            return True
+        if self.state == self.OPEN and time.monotonic() - self.opened_at >= self.reset_timeout:
+            self.state = self.HALF_OPEN
+            self._probe_in_flight = False
+        if self.state == self.HALF_OPEN and not self._probe_in_flight:
+            self._probe_in_flight = True
+            return True
+        return False
+
+    def record_success(self):
+        if self.state != self.CLOSED:
+            logging.info(f"Circuit breaker {self.name} closed")
+        self.state = self.CLOSED
+        self.failures = 0
+        self._probe_in_flight = False
+
+    def release_probe(self):
+        """Пробный запрос прерван без результата: следующий запрос снова может стать пробным."""
+        if self.state == self.HALF_OPEN:
+            self._probe_in_flight = False
+
+    def record_failure(self):
+        self.failures += 1
+        self._probe_in_flight = False
+        if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+            if self.state != self.OPEN:
+                logging.error(f"Circuit breaker {self.name} opened after {self.failures} failures")
+            self.state = self.OPEN
+            self.opened_at = time.monotonic()
+
+
+class _Endpoint:
+    def __init__(self, name, timeout, max_concurrency, breaker, hedged):
+        self.name = name
+        self.timeout = timeout
+        self.semaphore = asyncio.Semaphore(max_concurrency)
+        self.breaker = breaker
+        self.hedged = hedged
+        self.latencies = collections.deque(maxlen=LATENCY_WINDOW)
+
+    def hedge_delay(self, default, min_samples):
+        """p95 задержки по последним ответам или default, пока ответов мало."""
+        if len(self.latencies) < min_samples:
+            return default
+        ordered = sorted(self.latencies)
+        return ordered[int(len(ordered) * 0.95) - 1]
+
+
+class _RequestContext:
+    def __init__(self, client, method, url, kwargs):
+        self._client = client
+        self._method = method
+        self._url = url
+        self._kwargs = kwargs
+        self._endpoint = None
+        self._response = None
+
+    async def __aenter__(self):
+        self._endpoint, self._response = await self._client._send(self._method, self._url, self._kwargs)
+        return self._response
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self._response.release()
+        self._endpoint.semaphore.release()
+        # Таймаут или обрыв при чтении тела ответа - такой же отказ эндпоинта,
+        # как и ошибка при отправке запроса
+        if isinstance(exc, (aiohttp.ClientError, asyncio.TimeoutError)):
+            self._endpoint.breaker.record_failure()
+            raise BackendError(f"{self._method} {self._endpoint.name} failed while reading response: {exc!r}") from exc
+
+
+class ApiClient:
+    """Общий клиент для запросов к API robogpt.me.
+
+    Держит одну долгоживущую aiohttp-сессию с пулом keep-alive соединений,
+    поэтому TCP/TLS рукопожатие не повторяется на каждый запрос.
+    Для каждого эндпоинта (followers, contents, upload) свои таймаут,
+    ограничение одновременных запросов и предохранитель. Идемпотентные
+    запросы повторяются с задержкой и случайным разбросом. GET-запросы к
+    эндпоинтам из hedge_endpoints дублируются, если ответ не пришел за p95
+    задержки эндпоинта: используется тот ответ, что придет первым.
+    """
+
+    def __init__(self, api_key, limit=100, limit_per_host=30, dns_ttl=300,
+                 keepalive_timeout=30, total_timeout=15, connect_timeout=5, trace_configs=None,
+                 endpoint_timeouts=None, max_concurrency=50, queue_timeout=5, retries=2,
+                 retry_backoff=0.2, breaker_threshold=5, breaker_reset=30, hedge_endpoints=(),
+                 hedge_delay=0.5, hedge_min_samples=20):
+        self.api_key = api_key
+        self.limit = limit
+        self.limit_per_host = limit_per_host
+        self.dns_ttl = dns_ttl
+        self.keepalive_timeout = keepalive_timeout
+        self.timeout = aiohttp.ClientTimeout(total=total_timeout, connect=connect_timeout)
+        self.trace_configs = trace_configs or []
+        self.endpoint_timeouts = endpoint_timeouts or {}
+        self.connect_timeout = connect_timeout
+        self.max_concurrency = max_concurrency
+        self.queue_timeout = queue_timeout
+        self.retries = retries
+        self.retry_backoff = retry_backoff
+        self.breaker_threshold = breaker_threshold
+        self.breaker_reset = breaker_reset
+        self.hedge_endpoints = frozenset(hedge_endpoints)
+        self.hedge_delay = hedge_delay
+        self.hedge_min_samples = hedge_min_samples
+        self._endpoints = {}
+        self._session = None
+
+    async def start(self):
+        if self._session is not None and not self._session.closed:
+            return
+        connector = aiohttp.TCPConnector(
+            limit=self.limit,
+            limit_per_host=self.limit_per_host,
+            ttl_dns_cache=self.dns_ttl,
+            use_dns_cache=True,
+            keepalive_timeout=self.keepalive_timeout,
+        )
+        self._session = aiohttp.ClientSession(
+            connector=connector,
+            timeout=self.timeout,
+            headers={'Authorization': f'Bearer {self.api_key}'},
+            trace_configs=self.trace_configs,
+        )
+        logging.info(f"API client started: limit={self.limit}, limit_per_host={self.limit_per_host}")
+
+    async def close(self):
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+            logging.info("API client closed")
+        self._session = None
+
+    @property
+    def session(self):
+        if self._session is None or self._session.closed:
+            raise RuntimeError("API client is not started")
+        return self._session
+
+    def breakers(self):
+        return [endpoint.breaker for endpoint in self._endpoints.values()]
+
+    def request(self, method, url, **kwargs):
+        return _RequestContext(self, method, url, kwargs)
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request('POST', url, **kwargs)
+
+    def put(self, url, **kwargs):
+        return self.request('PUT', url, **kwargs)
+
+    def _endpoint(self, url):
+        # /api/followers/12 -> followers
+        parts = [part for part in URL(url).path.split('/') if part]
+        name = parts[1] if len(parts) > 1 and parts[0] == 'api' else (parts[0] if parts else '/')
+        endpoint = self._endpoints.get(name)
+        if endpoint is None:
+            total = self.endpoint_timeouts.get(name)
+            timeout = aiohttp.ClientTimeout(total=total, connect=self.connect_timeout) if total else self.timeout
+            breaker = CircuitBreaker(name, self.breaker_threshold, self.breaker_reset)
+            hedged = name in self.hedge_endpoints
+            endpoint = self._endpoints[name] = _Endpoint(name, timeout, self.max_concurrency, breaker, hedged)
+        return endpoint
+
+    async def _send(self, method, url, kwargs):
+        endpoint = self._endpoint(url)
+        try:
+            await asyncio.wait_for(endpoint.semaphore.acquire(), self.queue_timeout)
+        except asyncio.TimeoutError:
+            raise BackendBusyError(f"Too many concurrent requests to {endpoint.name}") from None
+
+        probing = False
+        try:
+            retries = self.retries if method in IDEMPOTENT_METHODS else 0
+            hedged = endpoint.hedged and method == 'GET'
+            for attempt in range(retries + 1):
+                if not endpoint.breaker.allow():
+                    raise CircuitOpenError(f"Circuit breaker for {endpoint.name} is open")
+                probing = endpoint.breaker.state == endpoint.breaker.HALF_OPEN
+                try:
+                    if hedged and not probing:
+                        response = await self._hedged_request(endpoint, method, url, kwargs)
+                    else:
+                        response = await self._request_once(endpoint, method, url, kwargs)
+                except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                    probing = False
+                    endpoint.breaker.record_failure()
+                    if attempt == retries:
+                        raise BackendError(f"{method} {endpoint.name} failed: {e!r}") from e
+                else:
+                    probing = False
+                    if response.status >= 500:
+                        endpoint.breaker.record_failure()
+                    else:
+                        endpoint.breaker.record_success()
+                    if response.status not in RETRY_STATUSES or attempt == retries:
+                        return endpoint, response
+                    response.release()
+                delay = self.retry_backoff * 2 ** attempt * random.uniform(0.5, 1.5)
+                logging.warning(f"Retrying {method} {endpoint.name} in {delay:.2f}s (attempt {attempt + 1})")
+                await asyncio.sleep(delay)
+        except BaseException:
+            # Отмененный или упавший с неожиданной ошибкой пробный запрос не должен держать предохранитель
+            if probing:
+                endpoint.breaker.release_probe()
+            endpoint.semaphore.release()
+            raise
+
+    async def _request_once(self, endpoint, method, url, kwargs):
+        started = time.monotonic()
+        response = await self.session.request(method, url, timeout=endpoint.timeout, **kwargs)
+        endpoint.latencies.append(time.monotonic() - started)
+        return response
+
+    async def _hedged_request(self, endpoint, method, url, kwargs):
+        """Отправляет запрос и, если он не ответил за p95, такой же второй; возвращает первый ответ."""
+        first = asyncio.ensure_future(self._request_once(endpoint, method, url, kwargs))
+        pending = {first}
+        try:
+            done, pending = await asyncio.wait(
+                pending, timeout=endpoint.hedge_delay(self.hedge_delay, self.hedge_min_samples))
+            if done:
+                return first.result()
+            logging.debug(f"Hedging slow {method} {endpoint.name}")
+            pending.add(asyncio.ensure_future(self._request_once(endpoint, method, url, kwargs)))
+            error = None
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                responses = [task.result() for task in done if task.exception() is None]
+                if responses:
+                    for extra in responses[1:]:
+                        extra.release()
+                    return responses[0]
+                error = error or next(iter(done)).exception()
+            raise error
+        finally:
+            # Опоздавший запрос больше не нужен
+            for task in pending:
+                task.cancel()
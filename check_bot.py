@@ -1,51 +1,242 @@
+import asyncio
+import functools
+import io
 import logging
 import os
-from telethon import TelegramClient, events, Button
+import tempfile
+from telethon import TelegramClient, events, Button, errors
+from telethon.tl import types
 import aiohttp
 import datetime
-from urllib.parse import unquote
-import base64
+
+from api_client import ApiClient, BackendError, CircuitOpenError
+from deep_link import DeepLinks, parse_legacy_payload
+from identity_cache import IdentityCache
+from keyed_lock import KeyedLock
+from media_cache import MediaCache
+import metrics
+from news_cache import NewsCache, NewsUnavailableError
+from questionnaire import COMPLETED_STATE, Questionnaire
+from state_store import create_state_store
+from send_scheduler import SendScheduler, PRIORITY_HIGH, PRIORITY_LOW
+from task_queue import TaskQueue
+from write_behind import WriteBehindQueue
 
 # Настройки для Telethon
 API_ID = os.environ['API_ID']  # Замените на ваш API_ID
 API_HASH = os.environ['API_HASH']  # Замените на ваш API_HASH
 TELEGRAM_BOT_TOKEN = os.environ['TELEGRAM_BOT_TOKEN']  # Замените на токен вашего бота
 API_KEY = os.environ['API_KEY']  # Замените на ваш реальный API-ключ
+TELEGRAM_SESSION = os.environ.get('TELEGRAM_SESSION', 'bot_session')
+# Воркеры sharded_bot.py получают обновления от ingress-процесса, а не от Telegram
+TELEGRAM_RECEIVE_UPDATES = os.environ.get('TELEGRAM_RECEIVE_UPDATES', '1') == '1'
+DEEP_LINK_SECRET = os.environ['DEEP_LINK_SECRET']  # Общий с генератором ссылок ключ подписи
+# Прием старых неподписанных ссылок /start. Удалить вместе с parse_legacy_payload после 2027-01-31,
+# когда старые ссылки перестанут встречаться в логах
+DEEP_LINK_ACCEPT_LEGACY = os.environ.get('DEEP_LINK_ACCEPT_LEGACY', '1') == '1'
+
+# Таблица кампаний, общая с генератором ссылок
+CAMPAIGNS_DB_PATH = os.environ.get('CAMPAIGNS_DB_PATH', 'campaigns.sqlite3')
+
+# Адрес API robogpt.me (для нагрузочного теста подменяется локальным сервером)
+API_BASE_URL = os.environ.get('API_BASE_URL', 'https://robogpt.me').rstrip('/')
+
+# Настройки пула соединений к API robogpt.me
+API_POOL_LIMIT = int(os.environ.get('API_POOL_LIMIT', 100))
+API_POOL_LIMIT_PER_HOST = int(os.environ.get('API_POOL_LIMIT_PER_HOST', 30))
+API_DNS_CACHE_TTL = int(os.environ.get('API_DNS_CACHE_TTL', 300))
+API_KEEPALIVE_TIMEOUT = float(os.environ.get('API_KEEPALIVE_TIMEOUT', 30))
+API_TOTAL_TIMEOUT = float(os.environ.get('API_TOTAL_TIMEOUT', 15))
+API_CONNECT_TIMEOUT = float(os.environ.get('API_CONNECT_TIMEOUT', 5))
+
+# Таймауты по эндпоинтам, повторы, ограничение параллельных запросов и предохранитель
+API_ENDPOINT_TIMEOUTS = {
+    'followers': float(os.environ.get('API_FOLLOWERS_TIMEOUT', 5)),
+    'contents': float(os.environ.get('API_CONTENTS_TIMEOUT', 10)),
+    'upload': float(os.environ.get('API_UPLOAD_TIMEOUT', 30)),
+}
+API_MAX_CONCURRENCY = int(os.environ.get('API_MAX_CONCURRENCY', 50))
+API_QUEUE_TIMEOUT = float(os.environ.get('API_QUEUE_TIMEOUT', 5))
+API_RETRIES = int(os.environ.get('API_RETRIES', 2))
+API_BREAKER_THRESHOLD = int(os.environ.get('API_BREAKER_THRESHOLD', 5))
+API_BREAKER_RESET = float(os.environ.get('API_BREAKER_RESET', 30))
+# Дублирование медленных GET-запросов: задержка до второго запроса, пока p95 еще не набран
+API_HEDGE_ENDPOINTS = ('followers', 'contents')
+API_HEDGE_DELAY = float(os.environ.get('API_HEDGE_DELAY', 0.5))
+
+# Настройки кэша новостей
+NEWS_CACHE_TTL = float(os.environ.get('NEWS_CACHE_TTL', 300))
+NEWS_PAGE_SIZE = int(os.environ.get('NEWS_PAGE_SIZE', 100))
+NEWS_RETRY_INTERVAL = float(os.environ.get('NEWS_RETRY_INTERVAL', 10))
+
+# Настройки хранилища состояния пользователей: memory или sqlite
+STATE_BACKEND = os.environ.get('STATE_BACKEND', 'sqlite')
+STATE_DB_PATH = os.environ.get('STATE_DB_PATH', 'bot_state.sqlite3')
+STATE_MAX_USERS = int(os.environ.get('STATE_MAX_USERS', 10000))
+STATE_TTL = float(os.environ.get('STATE_TTL', 30 * 24 * 3600))
+# Сколько секунд ждать блокировку SQLite другого процесса, не отпуская цикл событий
+STATE_DB_BUSY_TIMEOUT = float(os.environ.get('STATE_DB_BUSY_TIMEOUT', 0.25))
+
+# Настройки кэша идентификаторов пользователей
+IDENTITY_CACHE_TTL = float(os.environ.get('IDENTITY_CACHE_TTL', 3600))
+IDENTITY_CACHE_NEGATIVE_TTL = float(os.environ.get('IDENTITY_CACHE_NEGATIVE_TTL', 60))
+IDENTITY_CACHE_MAX_USERS = int(os.environ.get('IDENTITY_CACHE_MAX_USERS', 50000))
+
+# Настройки фоновой загрузки аватаров
+AVATAR_WORKERS = int(os.environ.get('AVATAR_WORKERS', 4))
+AVATAR_QUEUE_SIZE = int(os.environ.get('AVATAR_QUEUE_SIZE', 1000))
+AVATAR_RETRIES = int(os.environ.get('AVATAR_RETRIES', 3))
+AVATAR_MAX_BYTES = int(os.environ.get('AVATAR_MAX_BYTES', 5 * 1024 * 1024))
+AVATAR_CHUNK_SIZE = 64 * 1024
+# По умолчанию аватар держится в памяти; 1 - скачивать во временный файл
+AVATAR_SPILL_TO_DISK = os.environ.get('AVATAR_SPILL_TO_DISK', '0') == '1'
+
+# Кэш ссылок Telegram на медиа новостей
+MEDIA_CACHE_PATH = os.environ.get('MEDIA_CACHE_PATH', 'media_cache.sqlite3')
+MEDIA_WARMUP_WORKERS = int(os.environ.get('MEDIA_WARMUP_WORKERS', 2))
+
+# Настройки отложенной записи обновлений подписчиков
+FOLLOWER_WRITE_BATCH = int(os.environ.get('FOLLOWER_WRITE_BATCH', 100))
+FOLLOWER_WRITE_INTERVAL = float(os.environ.get('FOLLOWER_WRITE_INTERVAL', 2))
+FOLLOWER_WRITE_RETRIES = int(os.environ.get('FOLLOWER_WRITE_RETRIES', 5))
+FOLLOWER_WRITE_PATH = os.environ.get('FOLLOWER_WRITE_PATH', 'pending_follower_writes.json')
+
+# Лимиты исходящих сообщений Telegram
+SEND_GLOBAL_RATE = float(os.environ.get('SEND_GLOBAL_RATE', 30))
+SEND_CHAT_RATE = float(os.environ.get('SEND_CHAT_RATE', 1))
+SEND_CHAT_BURST = int(os.environ.get('SEND_CHAT_BURST', 3))
+
+# Метрики Prometheus (METRICS_PORT=0 отключает эндпоинт) и доля трассируемых обновлений
+METRICS_HOST = os.environ.get('METRICS_HOST', '127.0.0.1')
+METRICS_PORT = int(os.environ.get('METRICS_PORT', 9108))
+TRACE_SAMPLE_RATE = float(os.environ.get('TRACE_SAMPLE_RATE', 0))
+
+# Описание анкеты для новых пользователей
+QUESTIONNAIRE_PATH = os.environ.get('QUESTIONNAIRE_PATH', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'questionnaire.json'))
 
 # Настройка логирования
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+logging.basicConfig(level=os.environ.get('LOG_LEVEL', 'INFO'), format='%(asctime)s - %(levelname)s - %(message)s')
+
+metrics.trace_sample_rate = TRACE_SAMPLE_RATE
+metrics_server = metrics.MetricsServer(METRICS_HOST, METRICS_PORT) if METRICS_PORT else None
+
+# Разбор подписанных параметров /start
+deep_links = DeepLinks(DEEP_LINK_SECRET, CAMPAIGNS_DB_PATH)
+
+# Анкета загружается один раз при старте
+questionnaire = Questionnaire.load(QUESTIONNAIRE_PATH)
 
-# Глобальный словарь для хранения состояния пользователей
-user_responses = {}
+# Хранилище состояния пользователей
+user_store = create_state_store(STATE_BACKEND, path=STATE_DB_PATH, max_size=STATE_MAX_USERS, ttl=STATE_TTL,
+                                busy_timeout=STATE_DB_BUSY_TIMEOUT)
+
+# Кэш Telegram user_id -> db_user_id, чтобы не искать вернувшихся пользователей в API
+identity_cache = IdentityCache(
+    ttl=IDENTITY_CACHE_TTL,
+    negative_ttl=IDENTITY_CACHE_NEGATIVE_TTL,
+    max_size=IDENTITY_CACHE_MAX_USERS,
+    fields=questionnaire.fields,
+)
 
 # Создание клиента Telegram
-client = TelegramClient('bot_session', API_ID, API_HASH)
+client = TelegramClient(TELEGRAM_SESSION, API_ID, API_HASH, receive_updates=TELEGRAM_RECEIVE_UPDATES)
+
+# Все исходящие сообщения идут через планировщик с учетом лимитов Telegram
+outbox = SendScheduler(
+    client,
+    global_rate=SEND_GLOBAL_RATE,
+    global_burst=SEND_GLOBAL_RATE,
+    chat_rate=SEND_CHAT_RATE,
+    chat_burst=SEND_CHAT_BURST,
+)
+
+# Блокировки по user_id: события одного пользователя обрабатываются по очереди
+user_locks = KeyedLock()
+
+def serialized_per_user(handler):
+    """Не дает обработчикам выполняться параллельно для одного пользователя."""
+    @functools.wraps(handler)
+    async def wrapper(event):
+        async with user_locks.lock(event.sender_id):
+            return await handler(event)
+    return wrapper
+
+# Общий клиент API robogpt.me, создается в main()
+api = ApiClient(
+    API_KEY,
+    limit=API_POOL_LIMIT,
+    limit_per_host=API_POOL_LIMIT_PER_HOST,
+    dns_ttl=API_DNS_CACHE_TTL,
+    keepalive_timeout=API_KEEPALIVE_TIMEOUT,
+    total_timeout=API_TOTAL_TIMEOUT,
+    connect_timeout=API_CONNECT_TIMEOUT,
+    trace_configs=[metrics.make_trace_config()],
+    endpoint_timeouts=API_ENDPOINT_TIMEOUTS,
+    max_concurrency=API_MAX_CONCURRENCY,
+    queue_timeout=API_QUEUE_TIMEOUT,
+    retries=API_RETRIES,
+    breaker_threshold=API_BREAKER_THRESHOLD,
+    breaker_reset=API_BREAKER_RESET,
+    hedge_endpoints=API_HEDGE_ENDPOINTS,
+    hedge_delay=API_HEDGE_DELAY,
+)
+
+# Фоновая очередь для скачивания и загрузки аватаров новых пользователей
+avatar_queue = TaskQueue('avatars', workers=AVATAR_WORKERS, maxsize=AVATAR_QUEUE_SIZE, retries=AVATAR_RETRIES)
+
+# Медиа новостей загружаются в Telegram один раз, дальше отправляются по сохраненной ссылке
+media_cache = MediaCache(MEDIA_CACHE_PATH)
+media_queue = TaskQueue('news_media', workers=MEDIA_WARMUP_WORKERS)
+
+def schedule_media_warmup(items):
+    """Заранее загружает в Telegram медиа новостей, которых еще нет в кэше."""
+    if not client.is_connected():
+        return
+    for news in items:
+        if news.get('media_url') and media_cache.get(news['id'], news['media_url']) is None:
+            media_queue.submit(
+                functools.partial(media_cache.warm, client, news['id'], news['media_url']),
+                description=f"media for news {news['id']}"
+            )
+
+# Кэш ленты новостей, общий для всех пользователей
+news_cache = NewsCache(
+    api,
+    f'{API_BASE_URL}/api/contents',
+    ttl=NEWS_CACHE_TTL,
+    page_size=NEWS_PAGE_SIZE,
+    on_refresh=schedule_media_warmup,
+    retry_interval=NEWS_RETRY_INTERVAL,
+)
 
 @client.on(events.NewMessage(pattern='/start'))
+@metrics.instrument_handler('start')
+@serialized_per_user
 async def start(event):
     full_command = event.message.message
     logging.info(f"Full command received: {full_command}")
 
     # Проверяем, есть ли параметры после '/start '
+    utm_data = None
     if len(full_command.split()) > 1:
-        encoded_params = full_command.split(maxsplit=1)[1]
-        try:
-            # Добавляем недостающие символы "=" для декодирования
-            padding = '=' * (4 - len(encoded_params) % 4)
-            encoded_params += padding
-            decoded_params = base64.urlsafe_b64decode(encoded_params).decode()
-            logging.info(f"Decoded params: {decoded_params}")
-            utm_data = dict(param.split('=') for param in decoded_params.split('&') if '=' in param)
-            utm_source = utm_data.get('utm_source', 'unknown')
-            utm_medium = utm_data.get('utm_medium', 'unknown')
-            logging.info(f"Received UTM parameters: source={utm_source}, medium={utm_medium}")
-        except Exception as e:
-            logging.error(f"Error decoding params: {e}")
-            utm_source = utm_medium = 'unknown'
+        payload = full_command.split(maxsplit=1)[1]
+        # Сначала подписанный код кампании, затем старый формат ссылок
+        utm_data = deep_links.decode(payload)
+        if utm_data is None and DEEP_LINK_ACCEPT_LEGACY:
+            utm_data = parse_legacy_payload(payload)
+            if utm_data is not None:
+                logging.warning(f"Legacy unsigned start payload used: {payload}")
+        if utm_data is None:
+            logging.error(f"Invalid start payload: {payload}")
     else:
-        utm_source = utm_medium = 'unknown'
         logging.info("No UTM parameters found.")
 
+    utm_data = utm_data or {}
+    utm_source = utm_data.get('utm_source', 'unknown')
+    utm_medium = utm_data.get('utm_medium', 'unknown')
+    utm_campaign = utm_data.get('utm_campaign', 'unknown')
+    logging.info(f"Received UTM parameters: source={utm_source}, medium={utm_medium}, campaign={utm_campaign}")
+
     user_id = event.sender_id
     sender = await event.get_sender()
     first_name = sender.first_name or "Неизвестно"
@@ -54,57 +245,50 @@ async def start(event):
 
     logging.info(f"Received /start command from user_id {user_id}")
 
-    user_info = await check_user(user_id, first_name, last_name, telegram_username)
+    try:
+        user_info = await check_user(user_id)
+    except BackendError as e:
+        logging.error(f"Cannot check user_id {user_id}: {e}")
+        outbox.send_message(user_id, "Сервис временно недоступен. Пожалуйста, попробуйте позже.")
+        return
 
     if user_info is None:
         logging.info("User not found, proceeding with registration")
 
-        # Формируем путь к файлу с уникальным именем, включая user_id
-        photo_path = f'user_photo_{user_id}.jpg'
-
-        # Попытка загрузить аватар пользователя
-        try:
-            photo = await client.download_profile_photo(user_id, file=photo_path)
-            if photo:
-                logging.info(f"Avatar downloaded and saved as {photo_path}")
-            else:
-                logging.info("No avatar to download, proceeding without photo")
-                photo_path = None  # Устанавливаем photo_path в None, если фото нет
-        except Exception as e:
-            logging.error(f"Failed to download avatar: {str(e)}")
-            photo_path = None  # В случае ошибки также устанавливаем photo_path в None
-
+        # Аватар загружается в фоне после регистрации, чтобы не задерживать приветствие
         registration_response = await register_user(
             user_id=user_id,
             username=telegram_username,
             first_name=first_name,
             last_name=last_name,
-            photo_path=photo_path,
             utm_source=utm_source,
             utm_medium=utm_medium,
-            utm_campaign='unknown'
+            utm_campaign=utm_campaign
         )
 
         if registration_response:
             logging.info("Registration successful, starting user testing")
-            await client.send_message(user_id, f"Привет, {first_name}! Вы успешно зарегистрированы.")
+            outbox.send_message(user_id, f"Привет, {first_name}! Вы успешно зарегистрированы.", priority=PRIORITY_HIGH)
+            schedule_avatar_upload(user_id, registration_response['db_user_id'])
             await manage_user_testing(event)
         else:
             logging.error("Registration failed")
-            await client.send_message(user_id, "Не удалось зарегистрировать пользователя. Пожалуйста, попробуйте позже.")
-    elif not user_info.get('gender') or not user_info.get('country') or user_info.get('news_preference') is None:
+            outbox.send_message(user_id, "Не удалось зарегистрировать пользователя. Пожалуйста, попробуйте позже.")
+    elif not questionnaire.is_complete(user_info):
         logging.info("User found but missing some information, starting user testing")
         await manage_user_testing(event)
     else:
         logging.info("User found and all information is complete")
-        await client.send_message(user_id, f"Привет, {first_name}! Рады видеть вас снова.")
+        outbox.send_message(user_id, f"Привет, {first_name}! Рады видеть вас снова.")
 
 @client.on(events.NewMessage)
+@metrics.instrument_handler('handle_all_messages')
+@serialized_per_user
 async def handle_all_messages(event):
     user_id = event.sender_id
 
     # Проверка, находится ли пользователь в процессе тестирования
-    if user_responses.get(user_id, {}).get('in_testing'):
+    if user_store.get(user_id).get('in_testing'):
         logging.info(f"User is currently in testing, ignoring message: {event.text} from user_id: {user_id}")
         return
 
@@ -113,65 +297,113 @@ async def handle_all_messages(event):
         return
 
     logging.info(f"Handling general message: {event.text} from user_id {user_id}")
-    await event.respond('Добро пожаловать! Давай общаться.', buttons=Button.clear())
-
+    outbox.send_message(user_id, 'Добро пожаловать! Давай общаться.', buttons=Button.clear())
+
+
+# Размеры хранилищ и очередей считываются при каждом опросе /metrics
+metrics.register_gauge('bot_user_states', 'User states in the state store', lambda: len(user_store))
+metrics.register_gauge('bot_user_locks', 'Per-user handler locks held or awaited', lambda: len(user_locks))
+metrics.register_gauge('bot_identity_cache_entries', 'Entries in the identity cache', lambda: len(identity_cache))
+metrics.register_gauge('bot_outbox_queue_size', 'Outbound messages waiting to be sent', lambda: outbox.qsize())
+metrics.register_gauge('bot_avatar_queue_size', 'Avatar uploads waiting in the queue', lambda: avatar_queue.qsize())
+metrics.register_gauge('bot_backend_open_circuits', 'robogpt.me endpoints with an open circuit breaker',
+                       lambda: sum(breaker.state != breaker.CLOSED for breaker in api.breakers()))
+metrics.register_gauge('bot_pending_follower_writes', 'Follower updates waiting to be written', lambda: len(follower_writes))
+
+async def start_services():
+    """Запускает общие сервисы бота: клиент API, фоновые очереди и кэш новостей."""
+    if metrics_server is not None:
+        await metrics_server.start()
+    await api.start()
+    avatar_queue.start()
+    media_queue.start()
+    follower_writes.start()
+    outbox.start()
+    # Прогреваем кэш новостей до приема первых событий
+    await news_cache.refresh()
+
+async def stop_services():
+    """Дожидается фоновых задач и закрывает ресурсы в обратном порядке."""
+    await outbox.stop()
+    await avatar_queue.stop()
+    await media_queue.stop()
+    await follower_writes.stop()
+    await news_cache.close()
+    await api.close()
+    user_store.close()
+    deep_links.close()
+    media_cache.close()
+    if metrics_server is not None:
+        await metrics_server.stop()
+
+async def start_client():
+    """Подключает клиент Telegram и прогревает медиа новостей, загруженных до подключения."""
+    await client.start(bot_token=TELEGRAM_BOT_TOKEN)
+    schedule_media_warmup(news_cache.items())
 
 async def main():
     logging.info("Starting the bot")
-    await client.start(bot_token=TELEGRAM_BOT_TOKEN)
-    await client.run_until_disconnected()
-
-async def check_user(user_id, name, surname, telegram):
-    url = 'https://robogpt.me/api/followers/'
-    headers = {
-        'Authorization': f'Bearer {API_KEY}',
-        'Content-Type': 'application/json'
-    }
-    # Удаляем параметры с None значениями
+    await start_services()
+    try:
+        await start_client()
+        await client.run_until_disconnected()
+    finally:
+        await stop_services()
+
+async def check_user(user_id):
+    # Сначала смотрим в локальный кэш, в том числе отрицательные записи
+    found, profile = identity_cache.get(user_id)
+    if found:
+        if profile is None:
+            logging.info(f"User {user_id} is cached as not registered")
+            return None
+        user_store.update(user_id, **profile)
+        logging.info(f"db_user_id {profile['db_user_id']} found in identity cache for user_id {user_id}")
+        return profile
+
+    url = f'{API_BASE_URL}/api/followers/'
+    # Ищем по tgUserID, который сохраняет register_user: он не меняется при смене имени
     params = {
-        'filters[$and][0][name][$eq]': name,
-        'filters[$and][1][surname][$eq]': surname,
-        'filters[$and][2][telegram][$eq]': telegram
+        'filters[tgUserID][$eq]': user_id,
+        'pagination[limit]': 1
     }
-    params = {k: v for k, v in params.items() if v is not None}  # Очистка параметров от None значений
 
-    logging.info(f"Sending request to check user: {params}")
+    logging.debug("Sending request to check user: %s", params)
 
-    async with aiohttp.ClientSession() as session:
-        async with session.get(url, params=params, headers=headers) as response:
+    try:
+        async with api.get(url, params=params) as response:
             response_status = response.status
             response_data = await response.json() if response_status == 200 else {}
+            if response_status != 200:
+                raise BackendError(f"HTTP {response_status}: {await response.text()}")
+    except (BackendError, aiohttp.ClientError, ValueError) as e:
+        # API недоступно: отвечаем по сохраненному состоянию, если пользователь уже известен
+        user_state = user_store.get(user_id)
+        if user_state.get('db_user_id') is not None:
+            logging.warning(f"User check failed ({e}), using stored state for user_id {user_id}")
+            return user_state
+        raise BackendError(f"User check failed for user_id {user_id}: {e}") from e
+
+    logging.info(f"Received response for user check: Status {response_status}")
+    logging.debug("User check response data: %s", response_data)
+
+    if response_data.get('data'):
+        user_data = response_data['data'][0]['attributes']
+        user_data['db_user_id'] = response_data['data'][0]['id']
+        user_store.update(user_id, **user_data)  # Обновление с сохранением предыдущих данных
+        identity_cache.set(user_id, **user_data)
+        logging.info(f"db_user_id {user_data['db_user_id']} saved for user_id {user_id}")
+        return user_data
+    else:
+        user_store.update(user_id, db_user_id=None)  # Явное указание отсутствия db_user_id
+        identity_cache.set_missing(user_id)
+        logging.info(f"No db_user_id found for user_id {user_id}. Data set to None.")
+        return None
 
-            logging.info(f"Received response for user check: Status {response_status}, Data {response_data}")
-
-            if response_data['data']:
-                user_data = response_data['data'][0]['attributes']
-                user_data['db_user_id'] = response_data['data'][0]['id']
-                user_responses[user_id] = user_responses.get(user_id, {})
-                user_responses[user_id].update(user_data)  # Обновление с сохранением предыдущих данных
-                logging.info(f"db_user_id {user_data['db_user_id']} saved for user_id {user_id}")
-                return user_data
-            else:
-                user_responses[user_id] = user_responses.get(user_id, {})
-                user_responses[user_id].update({'db_user_id': None})  # Явное указание отсутствия db_user_id
-                logging.info(f"No db_user_id found for user_id {user_id}. Data set to None.")
-                return None
-
-async def register_user(user_id, username, first_name, last_name, photo_path, utm_source, utm_medium, utm_campaign):
+async def register_user(user_id, username, first_name, last_name, utm_source, utm_medium, utm_campaign):
     logging.info(f"Starting registration for user: {username}")
 
-    if photo_path:
-        try:
-            image_id = await upload_image_to_media_library(photo_path)
-            logging.info(f"Image uploaded successfully, image_id: {image_id}")
-        except Exception as e:
-            logging.error(f"Failed to upload image: {str(e)}")
-            image_id = None
-    else:
-        image_id = None
-
-    url = 'https://robogpt.me/api/followers'
-    headers = {'Authorization': f'Bearer {API_KEY}', 'Content-Type': 'application/json'}
+    url = f'{API_BASE_URL}/api/followers'
 
     data = {
         'data': {
@@ -184,117 +416,215 @@ async def register_user(user_id, username, first_name, last_name, photo_path, ut
             'surname': last_name,
             'blocked': False,
             'lastLogin': datetime.datetime.now().isoformat(),
-            'media': image_id,
             'type': 'New',
         }
     }
 
-    # Добавляем 'media' только если image_id не None
-    if image_id is not None:
-        data['data']['media'] = image_id
+    logging.debug("Sending registration data: %s", data)
 
-    logging.info(f"Sending registration data: {data}")
+    # POST может сохраниться на сервере, даже если ответ не дошел. Снимаем
+    # отрицательную запись заранее, чтобы после любой ошибки регистрации
+    # следующий /start снова искал пользователя в API, а не создавал дубликат
+    identity_cache.invalidate(user_id)
 
-    async with aiohttp.ClientSession() as session:
-        async with session.post(url, json=data, headers=headers) as response:
-            response_data = await response.json()
-            logging.info(f"Registration response: {response_data}")
-            if response.status == 200:
-                # Проверка наличия нужных данных в ответе
-                if 'data' in response_data and response_data['data']:
-                    user_data = response_data['data']
-                    user_data['db_user_id'] = user_data.get('id')
-                    user_responses[user_id] = user_data
-                    logging.info(f"User data saved with db_user_id {user_data['db_user_id']}")
-                    return user_data
-                else:
-                    logging.error("Registration data is missing in the response")
-                    return None
-            else:
+    try:
+        async with api.post(url, json=data) as response:
+            if response.status != 200:
                 logging.error(f"Failed to register user: HTTP {response.status}, Response: {await response.text()}")
                 return None
+            response_data = await response.json()
+    except (BackendError, aiohttp.ClientError, ValueError) as e:
+        logging.error(f"Failed to register user: {e}")
+        return None
+
+    logging.debug("Registration response: %s", response_data)
+    # Проверка наличия нужных данных в ответе
+    if 'data' in response_data and response_data['data']:
+        user_data = response_data['data']
+        user_data['db_user_id'] = user_data.get('id')
+        user_store.set(user_id, user_data)
+        identity_cache.set(user_id, user_data['db_user_id'])
+        logging.info(f"User data saved with db_user_id {user_data['db_user_id']}")
+        return user_data
+    else:
+        logging.error("Registration data is missing in the response")
+        return None
+
+def schedule_avatar_upload(user_id, db_user_id):
+    """Ставит скачивание и загрузку аватара пользователя в фоновую очередь."""
+    uploaded = {}
+
+    async def job():
+        # image_id сохраняется между повторами, чтобы не загружать фото дважды
+        if 'image_id' not in uploaded:
+            image_id = await upload_user_avatar(user_id)
+            if image_id is None:
+                return
+            uploaded['image_id'] = image_id
+            logging.info(f"Image uploaded successfully, image_id: {image_id}")
+        await update_user_media(db_user_id, uploaded['image_id'])
+
+    avatar_queue.submit(job, description=f"avatar for user_id {user_id}")
 
-async def upload_image_to_media_library(image_path):
-    url = 'https://robogpt.me/api/upload'
-    headers = {'Authorization': f'Bearer {API_KEY}'}
-    files = {'files': open(image_path, 'rb')}
-    async with aiohttp.ClientSession() as session:
-        async with session.post(url, data=files, headers=headers) as response:
-            if response.status == 200:
-                uploaded_media = await response.json()
-                return uploaded_media[0]['id']
-            else:
-                raise Exception(f"Failed to upload image: {await response.text()}")
+async def update_user_media(db_user_id, image_id):
+    url = f'{API_BASE_URL}/api/followers/{db_user_id}'
+    async with api.put(url, json={'data': {'media': image_id}}) as response:
+        if response.status != 200:
+            raise Exception(f"Failed to update media for db_user_id {db_user_id}: HTTP {response.status}, Response: {await response.text()}")
+        logging.info(f"Media {image_id} attached to db_user_id {db_user_id}")
+
+async def upload_user_avatar(user_id):
+    """Скачивает аватар пользователя и загружает его в медиатеку.
+
+    Возвращает image_id или None, если аватара нет или он больше AVATAR_MAX_BYTES.
+    """
+    filename = f'user_photo_{user_id}.jpg'
+
+    if AVATAR_SPILL_TO_DISK:
+        # Файловые операции выполняются в потоках, чтобы не блокировать цикл событий
+        fd, photo_path = await asyncio.to_thread(tempfile.mkstemp, prefix=f'avatar_{user_id}_', suffix='.jpg')
+        photo_file = os.fdopen(fd, 'w+b')
+
+        async def write_to_file(chunk):
+            await asyncio.to_thread(photo_file.write, chunk)
+
+        try:
+            if not await download_avatar(user_id, write_to_file):
+                return None
+            await asyncio.to_thread(photo_file.seek, 0)
+            # aiohttp читает файловое тело запроса в пуле потоков
+            return await upload_image_to_media_library(photo_file, filename)
+        finally:
+            await asyncio.to_thread(remove_temp_file, photo_file, photo_path)
+
+    buffer = io.BytesIO()
+
+    async def write_to_buffer(chunk):
+        buffer.write(chunk)
+
+    if not await download_avatar(user_id, write_to_buffer):
+        return None
+    buffer.seek(0)
+    return await upload_image_to_media_library(buffer, filename)
+
+def remove_temp_file(file, path):
+    file.close()
+    try:
+        os.unlink(path)
+    except FileNotFoundError:
+        pass
+
+async def download_avatar(user_id, write):
+    """Скачивает большой аватар пользователя частями по AVATAR_CHUNK_SIZE и передает их в write.
+
+    Скачивание прерывается, как только размер превышает AVATAR_MAX_BYTES,
+    так что в память или на диск попадает не больше лимита. Возвращает
+    число записанных байт или None, если аватара нет или он слишком большой.
+    """
+    user = await client.get_entity(user_id)
+    photo = getattr(user, 'photo', None)
+    if not isinstance(photo, types.UserProfilePhoto):
+        logging.info(f"No avatar to download for user_id {user_id}")
+        return None
+    location = types.InputPeerPhotoFileLocation(
+        peer=await client.get_input_entity(user),
+        photo_id=photo.photo_id,
+        big=True,
+    )
+    size = 0
+    async for chunk in client.iter_download(location, dc_id=photo.dc_id, request_size=AVATAR_CHUNK_SIZE):
+        size += len(chunk)
+        if size > AVATAR_MAX_BYTES:
+            logging.warning(f"Avatar of user_id {user_id} is larger than {AVATAR_MAX_BYTES} bytes, skipping")
+            return None
+        await write(chunk)
+    return size
+
+async def upload_image_to_media_library(image, filename):
+    """Загружает изображение (байты или открытый файл) в /api/upload и возвращает его id."""
+    url = f'{API_BASE_URL}/api/upload'
+    form = aiohttp.FormData()
+    form.add_field('files', image, filename=filename, content_type='image/jpeg')
+    async with api.post(url, data=form) as response:
+        if response.status == 200:
+            uploaded_media = await response.json()
+            return uploaded_media[0]['id']
+        else:
+            raise Exception(f"Failed to upload image: {await response.text()}")
 
 async def manage_user_testing(event, callback_data=None):
     user_id = event.sender_id
 
     # Проверка наличия данных пользователя и db_user_id
-    if user_id not in user_responses or 'db_user_id' not in user_responses[user_id]:
+    user_state = user_store.get(user_id)
+    if 'db_user_id' not in user_state:
         logging.error(f"No db_user_id found for user_id {user_id}, cannot proceed.")
-        await event.respond("Произошла ошибка во время обработки вашего запроса. Попробуйте перезапустить процесс.")
+        outbox.send_message(user_id, "Произошла ошибка во время обработки вашего запроса. Попробуйте перезапустить процесс.")
         return
 
     logging.info(f"Entered manage_user_testing for user_id {user_id} with event type {type(event).__name__}, data: {callback_data}")
 
     # Обновление состояния пользователя на основе callback данных
     if callback_data:
-        update_user_state(user_id, callback_data)
+        user_state = update_user_state(user_id, callback_data)
+        if user_state is None:
+            # Повторное нажатие или кнопка от уже отвеченного вопроса
+            logging.info(f"Ignoring stale callback {callback_data} from user_id {user_id}")
+            return
 
-    current_state = user_responses[user_id].get("state", "ask_gender")
+    current_state = user_state.get("state", questionnaire.first_state)
 
-    # Если состояние "ask_gender", значит тестирование начинается
-    if current_state == "ask_gender":
+    # Если это первый вопрос, значит тестирование начинается
+    if current_state == questionnaire.first_state and questionnaire.intro:
         # Отправляем приветственное сообщение перед первым вопросом
-        await client.send_message(user_id, "Пройдите, пожалуйста, небольшое тестирование из 3-х вопросов")
-
-    # Обработка состояний и отправка соответствующих вопросов или действий
-    if current_state == "ask_gender":
-        markup = [Button.inline("Мужчина", data="men"), Button.inline("Женщина", data="woman")]
-        await client.send_message(user_id, "Вы мужчина или женщина?", buttons=markup)
-    elif current_state == "ask_country":
-        markup = [Button.inline("Россия", data="Russia"), Button.inline("Другая страна", data="other")]
-        await client.send_message(user_id, "В какой стране вы проживаете?", buttons=markup)
-    elif current_state == "ask_news":
-        markup = [Button.inline("Да", data="yes"), Button.inline("Нет", data="no")]
-        await client.send_message(user_id, "Хотите ли вы получать новости?", buttons=markup)
-    elif current_state == "completed":
+        outbox.send_message(user_id, questionnaire.intro, priority=PRIORITY_HIGH)
+
+    # Отправка вопроса текущего состояния с заранее построенными кнопками
+    question = questionnaire.question(current_state)
+    if question is not None:
+        outbox.send_message(user_id, question.text, buttons=question.markup, priority=PRIORITY_HIGH)
+    elif current_state == COMPLETED_STATE:
+        identity_cache.update(user_id, **{field: user_state.get(field) for field in questionnaire.fields})
         # Проверка предпочтения получения новостей
-        if user_responses[user_id].get('news_preference', False):
+        if user_state.get('news_preference', False):
             # Сохраняем результаты перед отправкой новостей
-            await submit_responses(user_responses[user_id]['db_user_id'], user_responses[user_id])
+            await submit_responses(user_state['db_user_id'], user_state)
             await send_news(user_id)
         else:
-            await submit_responses(user_responses[user_id]['db_user_id'], user_responses[user_id])
-            await client.send_message(user_id, "Спасибо за ответы! Ваша информация сохранена.")
+            await submit_responses(user_state['db_user_id'], user_state)
+            outbox.send_message(user_id, "Спасибо за ответы! Ваша информация сохранена.", priority=PRIORITY_HIGH)
 
 def update_user_state(user_id, data):
-    """Обновляем состояние пользователя на основе полученного ответа."""
+    """Обновляем состояние пользователя на основе полученного ответа.
+
+    Возвращает новое состояние или None, если ответ не подходит к текущему вопросу.
+    """
     logging.info(f"Updating state for user_id {user_id} with data {data}")
-    state = user_responses[user_id].get("state", "ask_gender")
+    user_state = user_store.get(user_id)
+    state = user_state.get("state", questionnaire.first_state)
 
-    if state == "ask_gender":
-        if data == "men" or data == "woman":
-            user_responses[user_id]["gender"] = data
-            user_responses[user_id]["state"] = "ask_country"  # Переход к следующему вопросу
-        else:
-            logging.error("Invalid gender response received.")
-    elif state == "ask_country":
-        user_responses[user_id]["country"] = data
-        user_responses[user_id]["state"] = "ask_news"
-    elif state == "ask_news":
-        user_responses[user_id]["news_preference"] = True if data == "yes" else False
-        user_responses[user_id]["state"] = "completed"
-    else:
-        logging.error(f"Unhandled state: {state} with data: {data}")
+    result = questionnaire.answer(state, data)
+    if result is None:
+        logging.error(f"Invalid response for state {state}: {data}")
+        return None
 
-async def send_news(user_id):
-    if user_id not in user_responses:
-        user_responses[user_id] = {'news_index': 0}
-    elif 'news_index' not in user_responses[user_id]:
-        user_responses[user_id]['news_index'] = 0
+    field, value, next_state = result
+    user_state[field] = value
+    user_state["state"] = next_state  # Переход к следующему вопросу
+
+    user_store.set(user_id, user_state)
+    return user_state
 
-    news_list = await fetch_news(user_id)
+async def send_news(user_id):
+    news_index = user_store.get(user_id).get('news_index', 0)
+
+    try:
+        news_list = await fetch_news(news_index)
+    except NewsUnavailableError:
+        # Лента не загрузилась: это не конец ленты, статус Reader не ставим
+        logging.error(f"News feed is unavailable for user_id {user_id}")
+        outbox.send_message(user_id, "Новости временно недоступны. Пожалуйста, попробуйте позже.", priority=PRIORITY_LOW)
+        return
 
     if news_list:
         news = news_list[0]  # Поскольку fetch_news возвращает список с одной новостью
@@ -302,45 +632,50 @@ async def send_news(user_id):
         markup = [Button.inline("Далее", data="next_news")]
 
         if news['media_url']:
-            await client.send_file(user_id, news['media_url'], caption=news_text, buttons=markup)
+            send_news_media(user_id, news, news_text, markup)
         else:
-            await client.send_message(user_id, news_text, buttons=markup, parse_mode='md')
+            outbox.send_message(user_id, news_text, buttons=markup, parse_mode='md', priority=PRIORITY_LOW)
 
         # Увеличиваем индекс новости для пользователя
-        user_responses[user_id]['news_index'] += 1
+        user_store.update(user_id, news_index=news_index + 1)
     else:
-        await client.send_message(user_id, "Это была последняя новость.")
+        outbox.send_message(user_id, "Это была последняя новость.", priority=PRIORITY_LOW)
         await update_user_status(user_id, 'Reader')
-        user_responses[user_id]['news_index'] = 0  # Сброс индекса новостей для повторной итерации
-
-async def fetch_news(user_id):
-    current_index = user_responses[user_id].get('news_index', 0)
-    url = f'https://robogpt.me/api/contents?pagination[start]={current_index}&pagination[limit]=1'
-    headers = {
-        'Authorization': f'Bearer {API_KEY}',
-        'Content-Type': 'application/json'
-    }
-
-    logging.info("Fetching the next news item from the database.")
-
-    async with aiohttp.ClientSession() as session:
-        async with session.get(url, headers=headers) as response:
-            response_status = response.status
-            response_data = await response.json() if response_status == 200 else {}
-
-            if response_data.get('data', []):
-                item = response_data['data'][0]
-                return [{
-                    'name': item['attributes']['name'],
-                    'description': item['attributes']['description'],
-                    'content': item['attributes']['content_txt'],
-                    'media_url': item['attributes'].get('media_url')
-                }]
-            else:
-                logging.error("Failed to fetch news or no news available.")
-                return []
+        user_store.update(user_id, news_index=0)  # Сброс индекса новостей для повторной итерации
+
+def send_news_media(user_id, news, caption, markup, use_cache=True):
+    """Отправляет медиа новости, по возможности по сохраненной ссылке Telegram."""
+    cached = media_cache.get(news['id'], news['media_url']) if use_cache else None
+    future = outbox.send_file(user_id, cached or news['media_url'], caption=caption, buttons=markup, priority=PRIORITY_LOW)
+
+    def remember(future):
+        if future.cancelled():
+            return
+        error = future.exception()
+        if error is None:
+            if cached is None:
+                media_cache.put(news['id'], news['media_url'], getattr(future.result(), 'media', None))
+        elif cached is not None and isinstance(error, (errors.FileReferenceExpiredError, errors.MediaEmptyError)):
+            # Ссылка устарела: забываем ее и отправляем по URL, новая ссылка сохранится
+            logging.warning(f"Cached media for news {news['id']} is no longer valid: {error}")
+            media_cache.invalidate(news['id'], news['media_url'])
+            send_news_media(user_id, news, caption, markup, use_cache=False)
+
+    future.add_done_callback(remember)
+
+async def fetch_news(current_index):
+    logging.info(f"Fetching news item {current_index} from the news cache.")
+
+    news = await news_cache.get(current_index)
+    if news:
+        return [news]
+    else:
+        logging.info("No more news available.")
+        return []
 
 @client.on(events.CallbackQuery)
+@metrics.instrument_handler('handle_callback_query')
+@serialized_per_user
 async def handle_callback_query(event):
     user_id = event.sender_id
     data = event.data.decode('utf-8')
@@ -353,53 +688,44 @@ async def handle_callback_query(event):
     else:
         await manage_user_testing(event, callback_data=data)
 
+async def put_follower(db_user_id, data_to_send):
+    url = f'{API_BASE_URL}/api/followers/{db_user_id}'
+    async with api.put(url, json={'data': data_to_send}) as response:
+        response_text = await response.text()
+        if response.status != 200:
+            raise Exception(f"HTTP {response.status}, Response: {response_text}")
+        logging.info(f"Follower updated successfully for db_user_id {db_user_id}")
+        logging.debug("Follower update response for db_user_id %s: %s", db_user_id, response_text)
+
+# Обновления подписчиков отправляются пачками, несколько изменений одного db_user_id объединяются
+follower_writes = WriteBehindQueue(
+    'followers',
+    put_follower,
+    max_batch=FOLLOWER_WRITE_BATCH,
+    flush_interval=FOLLOWER_WRITE_INTERVAL,
+    retries=FOLLOWER_WRITE_RETRIES,
+    persist_path=FOLLOWER_WRITE_PATH,
+    # Пока предохранитель разомкнут, записи ждут в очереди, не расходуя попытки
+    transient_errors=(CircuitOpenError,),
+)
+
 async def submit_responses(db_user_id, responses):
-    url = f'https://robogpt.me/api/followers/{db_user_id}'
-    headers = {
-        'Authorization': f'Bearer {API_KEY}',
-        'Content-Type': 'application/json'
-    }
     # Объединяем данные ответов с обновлением статуса
-    data_to_send = {
-        'gender': responses.get("gender"),
-        'country': responses.get("country"),
-        'news_preference': responses.get("news_preference"),
-        'type': 'Tested'  # Обновляем статус на "Tested"
-    }
+    data_to_send = {field: responses.get(field) for field in questionnaire.fields}
+    data_to_send['type'] = 'Tested'  # Обновляем статус на "Tested"
 
-    logging.info(f"Submitting responses and updating status for db_user_id {db_user_id}: {data_to_send}")
-
-    async with aiohttp.ClientSession() as session:
-        async with session.put(url, json={'data': data_to_send}, headers=headers) as response:
-            response_text = await response.text()
-            if response.status == 200:
-                logging.info(f"User info and status updated successfully for db_user_id {db_user_id}. Server response: {response_text}")
-            else:
-                logging.error(f"Failed to update user info and status for db_user_id {db_user_id}: HTTP {response.status}, Response: {response_text}")
+    logging.info(f"Queueing responses and status update for db_user_id {db_user_id}")
+    logging.debug("Queued follower update for db_user_id %s: %s", db_user_id, data_to_send)
+    follower_writes.enqueue(db_user_id, data_to_send)
 
 async def update_user_status(user_id, new_status):
-    if user_id in user_responses and 'db_user_id' in user_responses[user_id]:
-        db_user_id = user_responses[user_id]['db_user_id']
-        url = f'https://robogpt.me/api/followers/{db_user_id}'
-        headers = {
-            'Authorization': f'Bearer {API_KEY}',
-            'Content-Type': 'application/json'
-        }
-        data_to_send = {
-            'type': new_status
-        }
-        logging.info(f"Updating user status to {new_status} for db_user_id {db_user_id}")
-
-        async with aiohttp.ClientSession() as session:
-            async with session.put(url, json={'data': data_to_send}, headers=headers) as response:
-                response_text = await response.text()
-                if response.status == 200:
-                    logging.info(f"User status updated successfully for db_user_id {db_user_id}. Server response: {response_text}")
-                else:
-                    logging.error(f"Failed to update user status for db_user_id {db_user_id}: HTTP {response.status}, Response: {response_text}")
+    user_state = user_store.get(user_id)
+    if user_state.get('db_user_id') is not None:
+        db_user_id = user_state['db_user_id']
+        logging.info(f"Queueing user status update to {new_status} for db_user_id {db_user_id}")
+        follower_writes.enqueue(db_user_id, {'type': new_status})
     else:
         logging.error(f"No db_user_id found for user_id {user_id}. Cannot update status.")
 
 if __name__ == '__main__':
-    client.start(bot_token=TELEGRAM_BOT_TOKEN)
-    client.run_until_disconnected()
+    client.loop.run_until_complete(main())
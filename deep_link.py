@@ -0,0 +1,118 @@
+import base64
+import functools
+import hashlib
+import hmac
+import sqlite3
+import struct
+from urllib.parse import parse_qsl
+
+PAYLOAD_VERSION = 1
+SIGNATURE_SIZE = 8
+# Версия (1 байт) + код кампании (4 байта) + подпись
+PAYLOAD_SIZE = 1 + 4 + SIGNATURE_SIZE
+UTM_FIELDS = ('utm_source', 'utm_medium', 'utm_campaign')
+# Старые ссылки не подписаны и никогда не содержали utm_campaign
+LEGACY_UTM_FIELDS = ('utm_source', 'utm_medium')
+# Telegram ограничивает параметр /start 64 символами
+MAX_START_PAYLOAD = 64
+
+
+class DeepLinks:
+    """Короткие подписанные параметры для ссылок t.me/<bot>?start=...
+
+    Набор UTM-меток хранится в локальной таблице кампаний, а в ссылку
+    попадает только его числовой код с HMAC-подписью: 18 символов base64url
+    вместо полной строки меток. Таблица общая для генератора ссылок и бота.
+    """
+
+    def __init__(self, secret, db_path, cache_size=10000):
+        self.secret = secret.encode() if isinstance(secret, str) else secret
+        self._conn = sqlite3.connect(db_path, timeout=5, isolation_level=None, check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute(
+            'CREATE TABLE IF NOT EXISTS campaigns ('
+            'code INTEGER PRIMARY KEY AUTOINCREMENT, '
+            'utm_source TEXT NOT NULL, utm_medium TEXT NOT NULL, utm_campaign TEXT NOT NULL, '
+            'UNIQUE (utm_source, utm_medium, utm_campaign))'
+        )
+        self.cache_size = cache_size
+        self.encode = functools.lru_cache(maxsize=cache_size)(self._encode)
+        # Проверка подписи не зависит от таблицы, поэтому кэшируется целиком
+        self._verify = functools.lru_cache(maxsize=cache_size)(self._verify_payload)
+        self.campaign_code = functools.lru_cache(maxsize=cache_size)(self._campaign_code)
+        # Кэшируются только найденные кампании: строка может появиться в таблице позже подписи ссылки
+        self._campaigns = {}
+
+    def make_payload(self, utm_source, utm_medium, utm_campaign='unknown'):
+        return self.encode(self.campaign_code(utm_source, utm_medium, utm_campaign))
+
+    def _campaign_code(self, utm_source, utm_medium, utm_campaign):
+        """Возвращает код кампании, при необходимости добавляя ее в таблицу."""
+        self._conn.execute(
+            'INSERT OR IGNORE INTO campaigns (utm_source, utm_medium, utm_campaign) VALUES (?, ?, ?)',
+            (utm_source, utm_medium, utm_campaign)
+        )
+        row = self._conn.execute(
+            'SELECT code FROM campaigns WHERE utm_source = ? AND utm_medium = ? AND utm_campaign = ?',
+            (utm_source, utm_medium, utm_campaign)
+        ).fetchone()
+        return row[0]
+
+    def _sign(self, body):
+        return hmac.new(self.secret, body, hashlib.sha256).digest()[:SIGNATURE_SIZE]
+
+    def _encode(self, code):
+        body = struct.pack('>BI', PAYLOAD_VERSION, code)
+        return base64.urlsafe_b64encode(body + self._sign(body)).decode().rstrip('=')
+
+    def decode(self, payload):
+        """Возвращает словарь UTM-меток или None для чужого или поддельного параметра."""
+        code = self._verify(payload)
+        if code is None:
+            return None
+        campaign = self._campaigns.get(code)
+        if campaign is None:
+            campaign = self._load_campaign(code)
+            if campaign is not None and len(self._campaigns) < self.cache_size:
+                self._campaigns[code] = campaign
+        return campaign
+
+    def _verify_payload(self, payload):
+        """Возвращает код кампании из параметра с верной подписью или None."""
+        if not payload or len(payload) > MAX_START_PAYLOAD:
+            return None
+        try:
+            raw = base64.urlsafe_b64decode(payload + '=' * (-len(payload) % 4))
+        except ValueError:
+            return None
+        if len(raw) != PAYLOAD_SIZE or raw[0] != PAYLOAD_VERSION:
+            return None
+        body, signature = raw[:5], raw[5:]
+        if not hmac.compare_digest(signature, self._sign(body)):
+            return None
+        _, code = struct.unpack('>BI', body)
+        return code
+
+    def _load_campaign(self, code):
+        row = self._conn.execute(
+            'SELECT utm_source, utm_medium, utm_campaign FROM campaigns WHERE code = ?', (code,)
+        ).fetchone()
+        return dict(zip(UTM_FIELDS, row)) if row else None
+
+    def close(self):
+        self._conn.close()
+
+
+@functools.lru_cache(maxsize=1024)
+def parse_legacy_payload(payload):
+    """Разбирает старый формат: base64url от строки utm_source=...&utm_medium=...
+
+    Подписи у старых ссылок нет, поэтому из них берутся только utm_source
+    и utm_medium, а кампания всегда остается неизвестной.
+    """
+    try:
+        decoded = base64.urlsafe_b64decode(payload + '=' * (-len(payload) % 4)).decode()
+    except ValueError:
+        return None
+    utm_data = {k: v for k, v in parse_qsl(decoded) if k in LEGACY_UTM_FIELDS}
+    return utm_data or None
@@ -0,0 +1,61 @@
+import time
+from collections import OrderedDict
+
+# Поля профиля по умолчанию, по которым /start решает, нужно ли тестирование
+PROFILE_FIELDS = ('gender', 'country', 'news_preference')
+
+
+class IdentityCache:
+    """Кэш соответствия Telegram user_id -> db_user_id и заполненности профиля.
+
+    Хранит и отрицательные записи (пользователь не найден), но с более
+    коротким TTL, чтобы регистрация в другом процессе быстро стала видна.
+    """
+
+    def __init__(self, ttl=3600, negative_ttl=60, max_size=50000, fields=PROFILE_FIELDS):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.max_size = max_size
+        self.fields = tuple(fields)
+        self._entries = OrderedDict()
+
+    def get(self, user_id):
+        """Возвращает (found, profile). profile равен None для отрицательной записи."""
+        entry = self._entries.get(user_id)
+        if entry is None:
+            return False, None
+        expires_at, profile = entry
+        if time.monotonic() >= expires_at:
+            del self._entries[user_id]
+            return False, None
+        self._entries.move_to_end(user_id)
+        return True, dict(profile) if profile is not None else None
+
+    def set(self, user_id, db_user_id, **fields):
+        profile = {'db_user_id': db_user_id}
+        profile.update({k: fields.get(k) for k in self.fields})
+        self._put(user_id, profile, self.ttl)
+        return profile
+
+    def set_missing(self, user_id):
+        self._put(user_id, None, self.negative_ttl)
+
+    def update(self, user_id, **fields):
+        """Обновляет поля профиля, если пользователь уже есть в кэше."""
+        found, profile = self.get(user_id)
+        if not found or profile is None:
+            return
+        profile.update({k: v for k, v in fields.items() if k in self.fields})
+        self._put(user_id, profile, self.ttl)
+
+    def invalidate(self, user_id):
+        self._entries.pop(user_id, None)
+
+    def _put(self, user_id, profile, ttl):
+        self._entries[user_id] = (time.monotonic() + ttl, profile)
+        self._entries.move_to_end(user_id)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def __len__(self):
+        return len(self._entries)
@@ -0,0 +1,32 @@
+import asyncio
+import contextlib
+
+
+class KeyedLock:
+    """Набор asyncio-блокировок по ключу (user_id).
+
+    События одного пользователя выполняются строго по очереди, события
+    разных пользователей - параллельно. Блокировка удаляется, как только
+    ее никто не держит и не ждет, поэтому память не растет со временем.
+    """
+
+    def __init__(self):
+        # key -> [lock, количество держащих и ожидающих]
+        self._locks = {}
+
+    @contextlib.asynccontextmanager
+    async def lock(self, key):
+        entry = self._locks.get(key)
+        if entry is None:
+            entry = self._locks[key] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                yield
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self._locks[key]
+
+    def __len__(self):
+        return len(self._locks)
@@ -0,0 +1,373 @@
+"""Нагрузочный тест check_bot.py без сети.
+
+Поднимает локальный сервер, имитирующий API robogpt.me (/api/followers,
+/api/contents, /api/upload) с настраиваемой задержкой, подменяет клиент
+Telegram заглушкой и прогоняет для N пользователей полный сценарий:
+/start с регистрацией -> ответы анкеты -> листание новостей.
+В конце печатает пропускную способность, перцентили задержек обработчиков,
+число запросов к API и рост памяти.
+
+Пример:
+    python load_test.py --users 2000 --concurrency 200 --latency 20
+"""
+import argparse
+import asyncio
+import collections
+import logging
+import os
+import resource
+import shutil
+import socket
+import sys
+import tempfile
+import time
+import tracemalloc
+from types import SimpleNamespace
+
+from aiohttp import web
+from telethon.tl import types
+
+# Небольшой валидный JPEG-заголовок вместо настоящего аватара
+FAKE_AVATAR = b'\xff\xd8\xff\xe0' + b'\x00' * 2048 + b'\xff\xd9'
+
+
+class FakeBackend:
+    """Имитация API robogpt.me в памяти."""
+
+    def __init__(self, latency=0.0, news_items=20, with_media=False):
+        self.latency = latency
+        self.calls = collections.Counter()
+        self.followers = {}
+        self.by_tg_user_id = {}
+        self.uploads = 0
+        self.contents = [
+            {
+                'id': i + 1,
+                'attributes': {
+                    'name': f'Новость {i + 1}',
+                    'description': 'Описание',
+                    'content_txt': 'Текст новости ' * 20,
+                    'media_url': f'https://example.com/news/{i + 1}.jpg' if with_media else None,
+                }
+            }
+            for i in range(news_items)
+        ]
+        self._runner = None
+
+    def make_app(self):
+        app = web.Application(client_max_size=10 * 1024 * 1024)
+        app.router.add_get('/api/followers/', self.get_followers)
+        app.router.add_get('/api/followers', self.get_followers)
+        app.router.add_post('/api/followers', self.post_follower)
+        app.router.add_put('/api/followers/{id}', self.put_follower)
+        app.router.add_get('/api/contents', self.get_contents)
+        app.router.add_post('/api/upload', self.upload)
+        return app
+
+    async def start(self, port):
+        self._runner = web.AppRunner(self.make_app(), access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, '127.0.0.1', port).start()
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+
+    async def _delay(self):
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+    async def get_followers(self, request):
+        self.calls['GET /api/followers'] += 1
+        await self._delay()
+        tg_user_id = request.query.get('filters[tgUserID][$eq]')
+        db_user_id = self.by_tg_user_id.get(tg_user_id)
+        data = [{'id': db_user_id, 'attributes': dict(self.followers[db_user_id])}] if db_user_id else []
+        return web.json_response({'data': data, 'meta': {}})
+
+    async def post_follower(self, request):
+        self.calls['POST /api/followers'] += 1
+        await self._delay()
+        attributes = (await request.json())['data']
+        db_user_id = len(self.followers) + 1
+        self.followers[db_user_id] = attributes
+        self.by_tg_user_id[str(attributes['tgUserID'])] = db_user_id
+        return web.json_response({'data': {'id': db_user_id, 'attributes': attributes}, 'meta': {}})
+
+    async def put_follower(self, request):
+        self.calls['PUT /api/followers/{id}'] += 1
+        await self._delay()
+        db_user_id = int(request.match_info['id'])
+        if db_user_id not in self.followers:
+            return web.json_response({'error': 'Not Found'}, status=404)
+        self.followers[db_user_id].update((await request.json())['data'])
+        return web.json_response({'data': {'id': db_user_id, 'attributes': self.followers[db_user_id]}})
+
+    async def get_contents(self, request):
+        self.calls['GET /api/contents'] += 1
+        await self._delay()
+        start = int(request.query.get('pagination[start]', 0))
+        limit = int(request.query.get('pagination[limit]', 25))
+        data = self.contents[start:start + limit]
+        return web.json_response({'data': data, 'meta': {'pagination': {'total': len(self.contents)}}})
+
+    async def upload(self, request):
+        self.calls['POST /api/upload'] += 1
+        await self._delay()
+        await request.read()
+        self.uploads += 1
+        return web.json_response([{'id': self.uploads}])
+
+
+class FakeTelegramClient:
+    """Заглушка TelegramClient: считает отправленные сообщения."""
+
+    def __init__(self):
+        self.calls = collections.Counter()
+        self._message_id = 0
+
+    def is_connected(self):
+        return True
+
+    def _message(self, media=None):
+        self._message_id += 1
+        return SimpleNamespace(id=self._message_id, media=media)
+
+    def _fake_photo(self):
+        self._message_id += 1
+        return types.MessageMediaPhoto(photo=types.Photo(
+            id=self._message_id, access_hash=1, file_reference=b'ref', date=None, sizes=[], dc_id=2))
+
+    async def __call__(self, request):
+        # Прогрев кэша медиа: messages.UploadMediaRequest
+        self.calls[type(request).__name__] += 1
+        return self._fake_photo()
+
+    async def send_message(self, chat_id, *args, **kwargs):
+        self.calls['send_message'] += 1
+        return self._message()
+
+    async def send_file(self, chat_id, file, *args, **kwargs):
+        if isinstance(file, str):
+            self.calls['send_file (by url)'] += 1
+        else:
+            self.calls['send_file (cached media)'] += 1
+        return self._message(self._fake_photo())
+
+    async def get_entity(self, user_id):
+        return types.User(id=user_id, access_hash=1, photo=types.UserProfilePhoto(photo_id=user_id, dc_id=2))
+
+    async def get_input_entity(self, entity):
+        return types.InputPeerUser(user_id=entity.id, access_hash=entity.access_hash)
+
+    async def iter_download(self, file, *, request_size=512 * 1024, **kwargs):
+        self.calls['iter_download (avatar)'] += 1
+        for offset in range(0, len(FAKE_AVATAR), request_size):
+            yield FAKE_AVATAR[offset:offset + request_size]
+
+
+class FakeMessageEvent:
+    def __init__(self, user_id, text):
+        self.sender_id = user_id
+        self.chat_id = user_id
+        self.text = text
+        self.message = SimpleNamespace(message=text)
+
+    async def get_sender(self):
+        return SimpleNamespace(first_name=f'User{self.sender_id}', last_name='Bench', username=f'user{self.sender_id}')
+
+    async def respond(self, *args, **kwargs):
+        pass
+
+
+class FakeCallbackEvent:
+    def __init__(self, user_id, data):
+        self.sender_id = user_id
+        self.chat_id = user_id
+        self.data = data.encode('utf-8')
+
+    async def answer(self, *args, **kwargs):
+        pass
+
+
+def percentile(values, q):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, round(q / 100 * len(ordered)) - 1))
+    return ordered[index]
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def configure_env(args, workdir, port):
+    """Заполняет переменные окружения, которые check_bot читает при импорте."""
+    defaults = {
+        'API_ID': '1',
+        'API_HASH': 'bench',
+        'TELEGRAM_BOT_TOKEN': 'bench',
+        'API_KEY': 'bench',
+        'DEEP_LINK_SECRET': 'bench',
+        'STATE_BACKEND': args.state_backend,
+        'STATE_DB_PATH': os.path.join(workdir, 'bot_state.sqlite3'),
+        'CAMPAIGNS_DB_PATH': os.path.join(workdir, 'campaigns.sqlite3'),
+        'FOLLOWER_WRITE_PATH': os.path.join(workdir, 'pending_follower_writes.json'),
+        'METRICS_PORT': '0',
+        'MEDIA_CACHE_PATH': os.path.join(workdir, 'media_cache.sqlite3'),
+        # Лимиты Telegram не относятся к заглушке, по умолчанию их снимаем
+        'SEND_GLOBAL_RATE': str(args.send_rate),
+        'SEND_CHAT_RATE': str(args.send_rate),
+        'SEND_CHAT_BURST': str(max(1, int(args.send_rate))),
+    }
+    for name, value in defaults.items():
+        os.environ.setdefault(name, value)
+    os.environ['API_BASE_URL'] = f'http://127.0.0.1:{port}'
+
+
+async def run_user(bot, user_id, payload, news_clicks, latencies):
+    async def timed(name, coro):
+        started = time.perf_counter()
+        await coro
+        latencies[name].append(time.perf_counter() - started)
+
+    # Telethon вызывает для /start оба обработчика NewMessage
+    start_event = FakeMessageEvent(user_id, f'/start {payload}')
+    await timed('start', bot.start(start_event))
+    await timed('handle_all_messages', bot.handle_all_messages(start_event))
+
+    questionnaire = bot.questionnaire
+    state = questionnaire.first_state
+    while state in questionnaire.questions:
+        # Всегда выбираем первый вариант ответа
+        data = next(iter(questionnaire.question(state).values))
+        await timed('handle_callback_query', bot.handle_callback_query(FakeCallbackEvent(user_id, data)))
+        state = questionnaire.answer(state, data)[2]
+
+    for _ in range(news_clicks):
+        await timed('next_news', bot.handle_callback_query(FakeCallbackEvent(user_id, 'next_news')))
+
+
+async def check_chat_throttling(scheduler_class, rate=20, burst=3, sends=10):
+    """Последовательные отправки в один чат должны упираться в лимит чата.
+
+    Возвращает время отправки и ожидаемый минимум.
+    """
+    fake_client = FakeTelegramClient()
+    scheduler = scheduler_class(fake_client, global_rate=1000000, global_burst=1000000,
+                                chat_rate=rate, chat_burst=burst)
+    scheduler.start()
+    started = time.perf_counter()
+    for i in range(sends):
+        # Каждое сообщение ставится после отправки предыдущего, как при нажатиях "Далее"
+        await scheduler.send_message(1, f'message {i}')
+    elapsed = time.perf_counter() - started
+    await scheduler.stop()
+    return elapsed, (sends - burst) / rate
+
+
+async def run(args):
+    workdir = tempfile.mkdtemp(prefix='tg_bot_load_test_')
+    port = free_port()
+    backend = FakeBackend(latency=args.latency / 1000, news_items=args.news_items, with_media=args.with_media)
+    await backend.start(port)
+
+    configure_env(args, workdir, port)
+    # TelegramClient создает файл сессии в текущем каталоге
+    cwd = os.getcwd()
+    os.chdir(workdir)
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import check_bot as bot
+    logging.getLogger().setLevel(args.log_level)
+
+    fake_client = FakeTelegramClient()
+    bot.client = fake_client
+    bot.outbox.client = fake_client
+
+    tracemalloc.start()
+    memory_before = tracemalloc.get_traced_memory()[0]
+    await bot.start_services()
+    payload = bot.deep_links.make_payload('load_test', 'bench', 'regression')
+
+    latencies = collections.defaultdict(list)
+    semaphore = asyncio.Semaphore(args.concurrency)
+
+    async def limited(user_id):
+        async with semaphore:
+            await run_user(bot, user_id, payload, args.news_clicks, latencies)
+
+    started = time.perf_counter()
+    results = await asyncio.gather(
+        *(limited(args.first_user_id + i) for i in range(args.users)),
+        return_exceptions=True
+    )
+    handlers_done = time.perf_counter()
+    memory_after, memory_peak = tracemalloc.get_traced_memory()
+    state_size = len(bot.user_store)
+    await bot.stop_services()
+    drained = time.perf_counter()
+    tracemalloc.stop()
+    await backend.stop()
+    os.chdir(cwd)
+    shutil.rmtree(workdir, ignore_errors=True)
+
+    errors = [r for r in results if isinstance(r, Exception)]
+    elapsed = handlers_done - started
+    events = sum(len(v) for v in latencies.values())
+
+    print(f"Users: {args.users}, concurrency: {args.concurrency}, backend latency: {args.latency} ms")
+    print(f"Handlers finished in {elapsed:.2f}s, background queues drained in {drained - handlers_done:.2f}s")
+    print(f"Throughput: {args.users / elapsed:.1f} users/s, {events / elapsed:.1f} events/s")
+    print(f"Failed users: {len(errors)}")
+    for error in errors[:5]:
+        print(f"  {type(error).__name__}: {error}")
+
+    print("\nHandler latency, ms:")
+    print(f"  {'handler':<24}{'count':>8}{'p50':>10}{'p95':>10}{'p99':>10}{'max':>10}")
+    for name, values in latencies.items():
+        print(f"  {name:<24}{len(values):>8}"
+              f"{percentile(values, 50) * 1000:>10.2f}{percentile(values, 95) * 1000:>10.2f}"
+              f"{percentile(values, 99) * 1000:>10.2f}{max(values) * 1000:>10.2f}")
+
+    print("\nBackend calls:")
+    for name, count in sorted(backend.calls.items()):
+        print(f"  {name:<32}{count:>8}  ({count / args.users:.2f} per user)")
+
+    print("\nTelegram calls:")
+    for name, count in sorted(fake_client.calls.items()):
+        print(f"  {name:<32}{count:>8}")
+
+    print("\nMemory:")
+    print(f"  traced growth: {(memory_after - memory_before) / 1024:.0f} KiB, peak: {memory_peak / 1024:.0f} KiB")
+    print(f"  max RSS: {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024:.0f} MiB")
+    print(f"  user states: {state_size}, user locks: {len(bot.user_locks)}")
+
+    throttle_elapsed, throttle_expected = await check_chat_throttling(bot.SendScheduler)
+    throttled = throttle_elapsed >= throttle_expected * 0.9
+    print("\nPer-chat send limit:")
+    print(f"  sequential sends took {throttle_elapsed:.2f}s, expected at least {throttle_expected:.2f}s"
+          f" - {'ok' if throttled else 'NOT THROTTLED'}")
+    return 1 if errors or not throttled else 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline load test for check_bot.py")
+    parser.add_argument('--users', type=int, default=1000, help="number of simulated users")
+    parser.add_argument('--concurrency', type=int, default=100, help="users running at the same time")
+    parser.add_argument('--latency', type=float, default=10, help="fake backend latency, ms")
+    parser.add_argument('--news-items', type=int, default=20, help="items in the fake news feed")
+    parser.add_argument('--news-clicks', type=int, default=5, help="'next_news' clicks per user")
+    parser.add_argument('--with-media', action='store_true', help="give every news item a media_url")
+    parser.add_argument('--first-user-id', type=int, default=100000)
+    parser.add_argument('--state-backend', default='memory', choices=('memory', 'sqlite'))
+    parser.add_argument('--send-rate', type=float, default=1000000, help="outbound Telegram rate limit, msg/s")
+    parser.add_argument('--log-level', default='WARNING')
+    args = parser.parse_args()
+    sys.exit(asyncio.run(run(args)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,92 @@
+import hashlib
+import logging
+import sqlite3
+
+from telethon import utils
+from telethon.tl import functions, types
+
+
+def url_hash(url):
+    return hashlib.sha1(url.encode('utf-8')).hexdigest()
+
+
+class MediaCache:
+    """Кэш ссылок Telegram на уже загруженные медиа новостей.
+
+    После первой отправки (или прогрева) медиа по media_url запоминается
+    ссылка на фото/документ Telegram, и следующие отправки используют ее
+    вместо повторной загрузки. Ключ - id новости и хеш URL, так что смена
+    картинки у новости дает новую запись. Ссылки хранятся в SQLite и
+    переживают перезапуск.
+    """
+
+    def __init__(self, path):
+        self._conn = sqlite3.connect(path, timeout=5, isolation_level=None, check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute(
+            'CREATE TABLE IF NOT EXISTS news_media ('
+            'content_id TEXT NOT NULL, url_hash TEXT NOT NULL, kind TEXT NOT NULL, '
+            'media_id INTEGER NOT NULL, access_hash INTEGER NOT NULL, file_reference BLOB NOT NULL, '
+            'PRIMARY KEY (content_id, url_hash))'
+        )
+        self._memory = {}
+
+    def get(self, content_id, url):
+        """Возвращает InputMedia для повторной отправки или None."""
+        key = (str(content_id), url_hash(url))
+        if key in self._memory:
+            return self._memory[key]
+        row = self._conn.execute(
+            'SELECT kind, media_id, access_hash, file_reference FROM news_media '
+            'WHERE content_id = ? AND url_hash = ?', key
+        ).fetchone()
+        media = self._to_input_media(*row) if row else None
+        if media is not None:
+            self._memory[key] = media
+        return media
+
+    def put(self, content_id, url, message_media):
+        """Запоминает медиа из отправленного сообщения (MessageMediaPhoto/Document)."""
+        if isinstance(message_media, types.MessageMediaPhoto) and isinstance(message_media.photo, types.Photo):
+            kind, item = 'photo', message_media.photo
+        elif isinstance(message_media, types.MessageMediaDocument) and isinstance(message_media.document, types.Document):
+            kind, item = 'document', message_media.document
+        else:
+            return
+        key = (str(content_id), url_hash(url))
+        self._conn.execute(
+            'INSERT OR REPLACE INTO news_media '
+            '(content_id, url_hash, kind, media_id, access_hash, file_reference) VALUES (?, ?, ?, ?, ?, ?)',
+            key + (kind, item.id, item.access_hash, item.file_reference)
+        )
+        self._memory[key] = self._to_input_media(kind, item.id, item.access_hash, item.file_reference)
+        logging.info(f"Cached Telegram {kind} for news {content_id}")
+
+    def invalidate(self, content_id, url):
+        key = (str(content_id), url_hash(url))
+        self._memory.pop(key, None)
+        self._conn.execute('DELETE FROM news_media WHERE content_id = ? AND url_hash = ?', key)
+
+    async def warm(self, client, content_id, url):
+        """Загружает медиа в Telegram без отправки пользователю и сохраняет ссылку."""
+        if self.get(content_id, url) is not None:
+            return
+        if utils.is_image(url):
+            media = types.InputMediaPhotoExternal(url=url)
+        else:
+            media = types.InputMediaDocumentExternal(url=url)
+        result = await client(functions.messages.UploadMediaRequest(peer=types.InputPeerSelf(), media=media))
+        self.put(content_id, url, result)
+
+    @staticmethod
+    def _to_input_media(kind, media_id, access_hash, file_reference):
+        if kind == 'photo':
+            return types.InputMediaPhoto(id=types.InputPhoto(
+                id=media_id, access_hash=access_hash, file_reference=bytes(file_reference)))
+        if kind == 'document':
+            return types.InputMediaDocument(id=types.InputDocument(
+                id=media_id, access_hash=access_hash, file_reference=bytes(file_reference)))
+        return None
+
+    def close(self):
+        self._conn.close()
@@ -0,0 +1,257 @@
+import bisect
+import contextvars
+import functools
+import logging
+import random
+import re
+import time
+
+import aiohttp
+from aiohttp import web
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Числовые идентификаторы в пути заменяются, чтобы не плодить метки
+_ID_IN_PATH = re.compile(r'/\d+(?=/|$)')
+
+
+def _format_labels(names, values, extra=None):
+    pairs = list(zip(names, values))
+    if extra:
+        pairs.append(extra)
+    if not pairs:
+        return ''
+    escaped = (str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, v in pairs)
+    return '{' + ','.join(f'{k}="{v}"' for (k, _), v in zip(pairs, escaped)) + '}'
+
+
+class Counter:
+    def __init__(self, name, help_text, labels=()):
+        self.name = name
+        self.help = help_text
+        self.labels = tuple(labels)
+        self._values = {}
+
+    def inc(self, *label_values, amount=1):
+        self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def collect(self):
+        yield f'# HELP {self.name} {self.help}'
+        yield f'# TYPE {self.name} counter'
+        for label_values, value in self._values.items():
+            yield f'{self.name}{_format_labels(self.labels, label_values)} {value}'
+
+
+class Gauge:
+    """Датчик: значение задается вручную или вычисляется функцией при опросе."""
+
+    def __init__(self, name, help_text, labels=(), func=None):
+        self.name = name
+        self.help = help_text
+        self.labels = tuple(labels)
+        self.func = func
+        self._values = {}
+
+    def inc(self, *label_values, amount=1):
+        self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def dec(self, *label_values, amount=1):
+        self.inc(*label_values, amount=-amount)
+
+    def set(self, value, *label_values):
+        self._values[label_values] = value
+
+    def collect(self):
+        yield f'# HELP {self.name} {self.help}'
+        yield f'# TYPE {self.name} gauge'
+        if self.func is not None:
+            try:
+                yield f'{self.name} {self.func()}'
+            except Exception as e:
+                logging.error(f"Failed to collect gauge {self.name}: {e}")
+            return
+        for label_values, value in self._values.items():
+            yield f'{self.name}{_format_labels(self.labels, label_values)} {value}'
+
+
+class Histogram:
+    def __init__(self, name, help_text, labels=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help_text
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        # label values -> [счетчики по корзинам, сумма, количество]
+        self._values = {}
+
+    def observe(self, value, *label_values):
+        entry = self._values.get(label_values)
+        if entry is None:
+            entry = self._values[label_values] = [[0] * len(self.buckets), 0.0, 0]
+        index = bisect.bisect_left(self.buckets, value)
+        if index < len(self.buckets):
+            entry[0][index] += 1
+        entry[1] += value
+        entry[2] += 1
+
+    def collect(self):
+        yield f'# HELP {self.name} {self.help}'
+        yield f'# TYPE {self.name} histogram'
+        for label_values, (counts, total, count) in self._values.items():
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                labels = _format_labels(self.labels, label_values, ('le', bound))
+                yield f'{self.name}_bucket{labels} {cumulative}'
+            labels = _format_labels(self.labels, label_values, ('le', '+Inf'))
+            yield f'{self.name}_bucket{labels} {count}'
+            labels = _format_labels(self.labels, label_values)
+            yield f'{self.name}_sum{labels} {total}'
+            yield f'{self.name}_count{labels} {count}'
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.collect())
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+handler_duration = registry.register(Histogram(
+    'bot_handler_duration_seconds', 'Telegram update handler latency', labels=('handler',)))
+handler_errors = registry.register(Counter(
+    'bot_handler_errors_total', 'Telegram update handlers that raised', labels=('handler',)))
+handlers_in_flight = registry.register(Gauge(
+    'bot_handlers_in_flight', 'Telegram update handlers currently running', labels=('handler',)))
+backend_duration = registry.register(Histogram(
+    'bot_backend_request_duration_seconds', 'robogpt.me API request latency', labels=('method', 'endpoint')))
+backend_errors = registry.register(Counter(
+    'bot_backend_errors_total', 'robogpt.me API requests that failed or returned an error status',
+    labels=('method', 'endpoint')))
+backends_in_flight = registry.register(Gauge(
+    'bot_backend_requests_in_flight', 'robogpt.me API requests currently running', labels=('method', 'endpoint')))
+
+
+def register_gauge(name, help_text, func):
+    """Регистрирует датчик, значение которого вычисляется при каждом опросе."""
+    return registry.register(Gauge(name, help_text, func=func))
+
+
+class Trace:
+    """Трассировка одного обновления: обработчик и вложенные запросы к API."""
+
+    def __init__(self, name):
+        self.trace_id = f'{random.getrandbits(64):016x}'
+        self.name = name
+        self.started = time.perf_counter()
+        self.spans = []
+
+    def add_span(self, name, duration, status=''):
+        self.spans.append((name, duration, status))
+
+    def finish(self, error=None):
+        duration = time.perf_counter() - self.started
+        spans = ', '.join(f'{name} {d * 1000:.1f}ms{" " + str(s) if s else ""}' for name, d, s in self.spans)
+        outcome = f" error={type(error).__name__}" if error else ''
+        logging.info(f"trace {self.trace_id} {self.name} {duration * 1000:.1f}ms{outcome} [{spans}]")
+
+
+current_trace = contextvars.ContextVar('current_trace', default=None)
+
+# Доля обновлений, для которых пишется трассировка (0 - выключено)
+trace_sample_rate = 0.0
+
+
+def instrument_handler(name):
+    """Декоратор обработчика: латентность, ошибки, число выполняемых и выборочная трассировка."""
+    def decorator(handler):
+        @functools.wraps(handler)
+        async def wrapper(*args, **kwargs):
+            trace = Trace(name) if trace_sample_rate and random.random() < trace_sample_rate else None
+            token = current_trace.set(trace)
+            handlers_in_flight.inc(name)
+            started = time.perf_counter()
+            error = None
+            try:
+                return await handler(*args, **kwargs)
+            except Exception as e:
+                error = e
+                handler_errors.inc(name)
+                raise
+            finally:
+                handler_duration.observe(time.perf_counter() - started, name)
+                handlers_in_flight.dec(name)
+                current_trace.reset(token)
+                if trace is not None:
+                    trace.finish(error)
+        return wrapper
+    return decorator
+
+
+def endpoint_label(url):
+    return _ID_IN_PATH.sub('/{id}', url.path.rstrip('/') or '/')
+
+
+def make_trace_config():
+    """TraceConfig для aiohttp, собирающий метрики запросов к API."""
+    async def on_request_start(session, context, params):
+        context.labels = (params.method, endpoint_label(params.url))
+        context.started = time.perf_counter()
+        backends_in_flight.inc(*context.labels)
+
+    def finish(context, status):
+        duration = time.perf_counter() - context.started
+        backend_duration.observe(duration, *context.labels)
+        backends_in_flight.dec(*context.labels)
+        trace = current_trace.get()
+        if trace is not None:
+            trace.add_span(' '.join(context.labels), duration, status)
+
+    async def on_request_end(session, context, params):
+        if params.response.status >= 400:
+            backend_errors.inc(*context.labels)
+        finish(context, params.response.status)
+
+    async def on_request_exception(session, context, params):
+        backend_errors.inc(*context.labels)
+        finish(context, type(params.exception).__name__)
+
+    trace_config = aiohttp.TraceConfig()
+    trace_config.on_request_start.append(on_request_start)
+    trace_config.on_request_end.append(on_request_end)
+    trace_config.on_request_exception.append(on_request_exception)
+    return trace_config
+
+
+class MetricsServer:
+    """HTTP-эндпоинт /metrics в текстовом формате Prometheus."""
+
+    def __init__(self, host='127.0.0.1', port=9108):
+        self.host = host
+        self.port = port
+        self._runner = None
+
+    async def _handle(self, request):
+        return web.Response(text=registry.render(), content_type='text/plain', charset='utf-8')
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_get('/metrics', self._handle)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, self.host, self.port).start()
+        logging.info(f"Metrics endpoint listening on http://{self.host}:{self.port}/metrics")
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
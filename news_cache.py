@@ -0,0 +1,155 @@
+import asyncio
+import logging
+import time
+
+
+class NewsUnavailableError(Exception):
+    """Лента новостей еще ни разу не загрузилась: сервер недоступен."""
+
+
+class NewsCache:
+    """Кэш ленты новостей из /api/contents.
+
+    Коллекция загружается крупными страницами и обновляется раз в ttl секунд,
+    поэтому кнопка "Далее" обслуживается из памяти, а не отдельным запросом.
+    Устаревшая лента продолжает отдаваться, пока новая загружается в фоне.
+    Конец ленты определяется по meta.pagination.total, а не по размеру
+    страницы: сервер может отдавать меньше page_size записей за раз.
+    После неудачной загрузки следующая попытка делается через retry_interval
+    секунд, а не через ttl.
+    Если сервер отдает ETag, повторная загрузка страницы идет с If-None-Match.
+    После каждого успешного обновления вызывается on_refresh(items).
+    """
+
+    def __init__(self, api, url, ttl=300, page_size=100, on_refresh=None, retry_interval=10):
+        self.api = api
+        self.url = url
+        self.ttl = ttl
+        self.page_size = page_size
+        self.on_refresh = on_refresh
+        self.retry_interval = retry_interval
+        self._items = []
+        self._etags = {}
+        self._pages = {}
+        self._loaded_at = None
+        self._available = False
+        self._lock = asyncio.Lock()
+        self._background = None
+
+    def items(self):
+        return list(self._items)
+
+    def is_stale(self):
+        return self._loaded_at is None or time.monotonic() - self._loaded_at >= self.ttl
+
+    async def get(self, index):
+        """Возвращает новость по индексу или None, если лента закончилась.
+
+        Если лента еще ни разу не загрузилась, бросает NewsUnavailableError.
+        """
+        if not self._available:
+            await self.refresh()
+            if not self._available:
+                raise NewsUnavailableError("News feed has not been loaded yet")
+        elif self.is_stale() and self._background is None:
+            # Отдаем то, что есть, а свежую ленту загружаем без ожидания
+            self._background = asyncio.create_task(self.refresh())
+            self._background.add_done_callback(self._refresh_done)
+        if 0 <= index < len(self._items):
+            return self._items[index]
+        return None
+
+    def _refresh_done(self, task):
+        self._background = None
+
+    async def close(self):
+        if self._background is not None:
+            self._background.cancel()
+            await asyncio.gather(self._background, return_exceptions=True)
+
+    async def refresh(self, force=False):
+        async with self._lock:
+            # Пока ждали блокировку, кэш мог обновить другой обработчик
+            if not force and not self.is_stale():
+                return
+            try:
+                items = await self._load_all()
+            except Exception as e:
+                logging.error(f"Failed to refresh news cache, keeping {len(self._items)} cached items: {e}")
+                # Не долбим упавший сервер на каждый клик, но и не ждем целый ttl
+                self._loaded_at = time.monotonic() - self.ttl + min(self.retry_interval, self.ttl)
+                return
+            self._items = items
+            self._available = True
+            self._loaded_at = time.monotonic()
+            logging.info(f"News cache refreshed: {len(items)} items")
+            if self.on_refresh is not None:
+                try:
+                    self.on_refresh(items)
+                except Exception as e:
+                    logging.error(f"News cache refresh callback failed: {e}")
+
+    async def _load_all(self):
+        items = []
+        start = 0
+        loaded = set()
+        while True:
+            loaded.add(start)
+            page, total = await self._load_page(start)
+            items.extend(page)
+            start += len(page)
+            # Пустая страница - конец ленты, даже если сервер не вернул total
+            if not page or (total is not None and start >= total):
+                break
+        # Страницы за концом ленты или со старыми смещениями больше не нужны
+        for stale_start in [s for s in self._pages if s not in loaded]:
+            self._pages.pop(stale_start, None)
+            self._etags.pop(stale_start, None)
+        return items
+
+    async def _load_page(self, start):
+        """Возвращает записи страницы и общее число записей в ленте (или None)."""
+        params = {
+            'pagination[start]': start,
+            'pagination[limit]': self.page_size,
+        }
+        headers = {}
+        if start in self._etags and start in self._pages:
+            headers['If-None-Match'] = self._etags[start]
+
+        async with self.api.get(self.url, params=params, headers=headers) as response:
+            if response.status == 304:
+                return self._pages[start]
+            if response.status != 200:
+                raise Exception(f"HTTP {response.status}: {await response.text()}")
+            response_data = await response.json()
+
+            page = [self._parse_item(item) for item in response_data.get('data') or []]
+            total = self._total(response_data.get('meta') or {})
+            self._pages[start] = page, total
+            etag = response.headers.get('ETag')
+            if etag:
+                self._etags[start] = etag
+            else:
+                self._etags.pop(start, None)
+            return page, total
+
+    @staticmethod
+    def _total(meta):
+        pagination = meta.get('pagination') or {}
+        if pagination.get('total') is not None:
+            return int(pagination['total'])
+        if pagination.get('pageCount') is not None and pagination.get('pageSize') is not None:
+            # Постраничный ответ без total: верхняя граница, конец найдем по пустой странице
+            return int(pagination['pageCount']) * int(pagination['pageSize'])
+        return None
+
+    @staticmethod
+    def _parse_item(item):
+        return {
+            'id': item.get('id'),
+            'name': item['attributes']['name'],
+            'description': item['attributes']['description'],
+            'content': item['attributes']['content_txt'],
+            'media_url': item['attributes'].get('media_url')
+        }
@@ -0,0 +1,82 @@
+import json
+
+from telethon import Button
+
+COMPLETED_STATE = 'completed'
+
+
+class Question:
+    """Скомпилированный вопрос анкеты с готовой клавиатурой и таблицей переходов."""
+
+    __slots__ = ('state', 'field', 'text', 'markup', 'values', 'transitions')
+
+    def __init__(self, state, field, text, markup, values, transitions):
+        self.state = state
+        self.field = field
+        self.text = text
+        self.markup = markup
+        # callback data -> значение поля
+        self.values = values
+        # callback data -> следующее состояние
+        self.transitions = transitions
+
+
+class Questionnaire:
+    """Анкета, описанная данными.
+
+    Описание (см. questionnaire.json) компилируется один раз при загрузке:
+    для каждого состояния заранее строятся кнопки Button.inline и словари
+    ответов, поэтому обработка callback - это пара поисков в словаре.
+    Переход по ответу задается полем "next" у ответа, иначе анкета
+    переходит к следующему вопросу по списку.
+    """
+
+    def __init__(self, definition):
+        self.intro = definition.get('intro')
+        self.questions = {}
+        specs = definition['questions']
+        if not specs:
+            raise ValueError("Questionnaire has no questions")
+
+        for index, spec in enumerate(specs):
+            state = spec['state']
+            if state in self.questions or state == COMPLETED_STATE:
+                raise ValueError(f"Duplicate questionnaire state: {state}")
+            default_next = specs[index + 1]['state'] if index + 1 < len(specs) else COMPLETED_STATE
+            markup = []
+            values = {}
+            transitions = {}
+            for answer in spec['answers']:
+                data = answer['data']
+                if data in values:
+                    raise ValueError(f"Duplicate answer {data} in state {state}")
+                markup.append(Button.inline(answer['label'], data=data))
+                values[data] = answer.get('value', data)
+                transitions[data] = answer.get('next', default_next)
+            self.questions[state] = Question(state, spec['field'], spec['text'], markup, values, transitions)
+
+        for question in self.questions.values():
+            for next_state in question.transitions.values():
+                if next_state != COMPLETED_STATE and next_state not in self.questions:
+                    raise ValueError(f"Unknown next state {next_state} in state {question.state}")
+
+        self.first_state = specs[0]['state']
+        self.fields = tuple(question.field for question in self.questions.values())
+
+    @classmethod
+    def load(cls, path):
+        with open(path, encoding='utf-8') as f:
+            return cls(json.load(f))
+
+    def question(self, state):
+        return self.questions.get(state)
+
+    def answer(self, state, data):
+        """Возвращает (поле, значение, следующее состояние) или None для неподходящего ответа."""
+        question = self.questions.get(state)
+        if question is None or data not in question.values:
+            return None
+        return question.field, question.values[data], question.transitions[data]
+
+    def is_complete(self, profile):
+        return all(profile.get(field) not in (None, '') for field in self.fields)
@@ -0,0 +1,199 @@
+import asyncio
+import collections
+import heapq
+import itertools
+import logging
+import time
+
+from telethon import errors
+
+# Классы приоритета: меньше - важнее
+PRIORITY_HIGH = 0  # регистрация и анкета
+PRIORITY_NORMAL = 1  # прочие ответы
+PRIORITY_LOW = 2  # лента новостей
+
+
+class TokenBucket:
+    """Ведро токенов: rate токенов в секунду, не больше burst подряд."""
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def time_to_full(self):
+        """Сколько секунд ведро будет наполняться до burst."""
+        self._refill()
+        return max(0.0, (self.burst - self.tokens) / self.rate)
+
+    def reserve(self):
+        """Забирает токен и возвращает, сколько секунд нужно подождать до его появления."""
+        self._refill()
+        self.tokens -= 1
+        return max(0.0, -self.tokens / self.rate)
+
+
+class _Chat:
+    def __init__(self, rate, burst):
+        self.bucket = TokenBucket(rate, burst)
+        self.queue = collections.deque()
+        # Чат ждет токена, стоит в очереди готовых или отправляет сообщение
+        self.scheduled = False
+
+
+class SendScheduler:
+    """Планировщик исходящих сообщений Telegram.
+
+    У каждого чата своя очередь, и его сообщения уходят строго в порядке
+    постановки, по одному. Приоритет решает только, какой из готовых чатов
+    обслужить первым. Чат становится готовым, когда в его ведре токенов
+    есть токен, так что частые сообщения одного пользователя не занимают
+    слоты отправки других. Общая скорость ограничена глобальным ведром.
+    При FloodWaitError отправка во все чаты приостанавливается на
+    указанное Telegram время.
+    """
+
+    def __init__(self, client, global_rate=30, global_burst=30, chat_rate=1, chat_burst=3,
+                 max_in_flight=100, flood_retries=3):
+        self.client = client
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.flood_retries = flood_retries
+        self._global = TokenBucket(global_rate, global_burst)
+        self._chats = {}
+        # (priority, seq, chat_id) для чатов, которые можно обслужить прямо сейчас
+        self._ready = []
+        self._wakeup = asyncio.Event()
+        self._counter = itertools.count()
+        self._in_flight = asyncio.Semaphore(max_in_flight)
+        self._unsent = 0
+        self._idle = asyncio.Event()
+        self._idle.set()
+        self._paused_until = 0.0
+        self._dispatcher = None
+        self._tasks = set()
+
+    def start(self):
+        if self._dispatcher is None:
+            self._dispatcher = asyncio.create_task(self._dispatch())
+
+    async def stop(self, timeout=10):
+        """Дожидается отправки поставленных сообщений и останавливает планировщик."""
+        if self._dispatcher is None:
+            return
+        try:
+            await asyncio.wait_for(self._idle.wait(), timeout)
+        except asyncio.TimeoutError:
+            logging.error(f"Send scheduler stopped with {self._unsent} unsent messages")
+        self._dispatcher.cancel()
+        await asyncio.gather(self._dispatcher, *self._tasks, return_exceptions=True)
+        self._dispatcher = None
+
+    def send_message(self, chat_id, *args, priority=PRIORITY_NORMAL, **kwargs):
+        return self._submit(self.client.send_message, chat_id, args, kwargs, priority)
+
+    def send_file(self, chat_id, *args, priority=PRIORITY_NORMAL, **kwargs):
+        return self._submit(self.client.send_file, chat_id, args, kwargs, priority)
+
+    def qsize(self):
+        return self._unsent
+
+    def _submit(self, method, chat_id, args, kwargs, priority):
+        """Ставит отправку в очередь чата и возвращает future с результатом.
+
+        Дожидаться future не обязательно: ошибки отправки логируются.
+        """
+        future = asyncio.get_running_loop().create_future()
+        future.add_done_callback(self._log_failure)
+        chat = self._chats.get(chat_id)
+        if chat is None:
+            chat = self._chats[chat_id] = _Chat(self.chat_rate, self.chat_burst)
+        chat.queue.append((priority, next(self._counter), method, args, kwargs, future))
+        self._unsent += 1
+        self._idle.clear()
+        if not chat.scheduled:
+            self._schedule(chat_id, chat)
+        return future
+
+    @staticmethod
+    def _log_failure(future):
+        if not future.cancelled() and future.exception() is not None:
+            logging.error(f"Failed to send message: {future.exception()}")
+
+    def _schedule(self, chat_id, chat):
+        """Резервирует токен чата и ставит чат в очередь готовых, когда токен появится."""
+        chat.scheduled = True
+        delay = chat.bucket.reserve()
+        if delay > 0:
+            asyncio.get_running_loop().call_later(delay, self._make_ready, chat_id, chat)
+        else:
+            self._make_ready(chat_id, chat)
+
+    def _make_ready(self, chat_id, chat):
+        priority, seq = chat.queue[0][:2]
+        heapq.heappush(self._ready, (priority, seq, chat_id))
+        self._wakeup.set()
+
+    def _evict(self, chat_id, chat):
+        if self._chats.get(chat_id) is chat and not chat.scheduled and chat.bucket.time_to_full() == 0:
+            del self._chats[chat_id]
+
+    async def _wait_global(self):
+        pause = self._paused_until - time.monotonic()
+        if pause > 0:
+            await asyncio.sleep(pause)
+        delay = self._global.reserve()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    async def _dispatch(self):
+        while True:
+            while not self._ready:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+            await self._in_flight.acquire()
+            await self._wait_global()
+            # Берем лучший готовый чат после ожидания: за это время могли появиться важнее
+            _, _, chat_id = heapq.heappop(self._ready)
+            chat = self._chats[chat_id]
+            task = asyncio.create_task(self._send(chat_id, chat, chat.queue.popleft()))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _send(self, chat_id, chat, item):
+        _, _, method, args, kwargs, future = item
+        try:
+            for attempt in range(self.flood_retries + 1):
+                try:
+                    result = await method(chat_id, *args, **kwargs)
+                    if not future.done():
+                        future.set_result(result)
+                    break
+                except errors.FloodWaitError as e:
+                    logging.warning(f"FloodWait for {e.seconds}s while sending to chat {chat_id}")
+                    self._paused_until = max(self._paused_until, time.monotonic() + e.seconds)
+                    if attempt == self.flood_retries:
+                        raise
+                    await self._wait_global()
+        except Exception as e:
+            if not future.done():
+                future.set_exception(e)
+        finally:
+            self._in_flight.release()
+            # Следующее сообщение чата ставится в очередь только после отправки текущего
+            if chat.queue:
+                self._schedule(chat_id, chat)
+            else:
+                chat.scheduled = False
+                # Ведро чата нужно и после отправки: иначе следующее сообщение
+                # получило бы полный burst. Чат удаляется, когда ведро наполнится
+                asyncio.get_running_loop().call_later(chat.bucket.time_to_full(), self._evict, chat_id, chat)
+            self._unsent -= 1
+            if self._unsent == 0:
+                self._idle.set()
@@ -0,0 +1,215 @@
+"""Запуск бота на нескольких ядрах.
+
+Один ingress-процесс держит соединение Telethon и получает обновления,
+а обрабатывают их N воркеров. Каждый воркер - это отдельный процесс с
+обычными обработчиками check_bot.py (start, handle_all_messages,
+handle_callback_query). Обновления распределяются по воркерам по
+user_id, поэтому события одного пользователя всегда попадают в один
+воркер и обрабатываются по порядку.
+
+Пример:
+    python sharded_bot.py --workers 4
+"""
+import argparse
+import asyncio
+import logging
+import multiprocessing
+import os
+import queue
+import re
+import signal
+from types import SimpleNamespace
+
+from telethon import TelegramClient, events
+from telethon.tl import types
+
+START_PATTERN = re.compile('/start')
+
+
+def shard_for(user_id, workers):
+    return user_id % workers
+
+
+def serialize_sender(sender):
+    if sender is None:
+        return None
+    return {
+        'id': sender.id,
+        'access_hash': getattr(sender, 'access_hash', None),
+        'first_name': getattr(sender, 'first_name', None),
+        'last_name': getattr(sender, 'last_name', None),
+        'username': getattr(sender, 'username', None),
+    }
+
+
+class WorkerMessageEvent:
+    """Сообщение, переданное воркеру: повторяет нужную обработчикам часть events.NewMessage."""
+
+    def __init__(self, client, item):
+        self._client = client
+        self.sender_id = item['sender_id']
+        self.chat_id = item['chat_id']
+        self.text = item['text']
+        self.message = SimpleNamespace(message=item['text'])
+        self._sender = item['sender']
+
+    async def get_sender(self):
+        if self._sender:
+            return SimpleNamespace(**self._sender)
+        # Ingress не нашел отправителя в обновлении, запрашиваем его сами
+        return await self._client.get_entity(self.sender_id)
+
+    async def respond(self, *args, **kwargs):
+        return await self._client.send_message(self.chat_id, *args, **kwargs)
+
+
+class WorkerCallbackEvent(WorkerMessageEvent):
+    """Нажатие inline-кнопки. На callback уже ответил ingress-процесс."""
+
+    def __init__(self, client, item):
+        super().__init__(client, item)
+        self.data = item['data']
+
+    async def answer(self, *args, **kwargs):
+        pass
+
+
+async def run_ingress(queues):
+    session = os.environ.get('TELEGRAM_SESSION', 'bot_session')
+    client = TelegramClient(session, os.environ['API_ID'], os.environ['API_HASH'])
+
+    def route(item):
+        index = shard_for(item['sender_id'], len(queues))
+        try:
+            queues[index].put_nowait(item)
+        except queue.Full:
+            logging.error(f"Worker {index} queue is full, dropping {item['kind']} from user_id {item['sender_id']}")
+
+    # Telethon обрабатывает каждое обновление в отдельной задаче, поэтому
+    # событие передается воркеру до первого await: иначе два быстрых нажатия
+    # одного пользователя могут прийти к воркеру в обратном порядке.
+    # Отправитель берется из сущностей самого обновления, без запросов к Telegram.
+    @client.on(events.NewMessage)
+    async def on_message(event):
+        route({
+            'kind': 'message',
+            'sender_id': event.sender_id,
+            'chat_id': event.chat_id,
+            'text': event.message.message,
+            'sender': serialize_sender(event.sender),
+        })
+
+    @client.on(events.CallbackQuery)
+    async def on_callback(event):
+        route({
+            'kind': 'callback',
+            'sender_id': event.sender_id,
+            'chat_id': event.chat_id,
+            'text': '',
+            'data': event.data,
+            'sender': serialize_sender(event.sender),
+        })
+        # Отвечаем сразу, чтобы у пользователя не крутился индикатор загрузки
+        await event.answer()
+
+    logging.info(f"Starting ingress for {len(queues)} workers")
+    await client.start(bot_token=os.environ['TELEGRAM_BOT_TOKEN'])
+    await client.run_until_disconnected()
+
+
+def worker_main(index, workers, work_queue):
+    # Ctrl+C обрабатывает родительский процесс: воркер дорабатывает очередь до None
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    # Настройки, которые не должны совпадать у разных процессов
+    os.environ['TELEGRAM_SESSION'] = f"{os.environ.get('TELEGRAM_SESSION', 'bot_session')}_worker{index}"
+    os.environ['TELEGRAM_RECEIVE_UPDATES'] = '0'
+    # Лимит Telegram общий для бота, поэтому каждый воркер получает свою долю
+    os.environ['SEND_GLOBAL_RATE'] = str(float(os.environ.get('SEND_GLOBAL_RATE', 30)) / workers)
+    os.environ['FOLLOWER_WRITE_PATH'] = f"{os.environ.get('FOLLOWER_WRITE_PATH', 'pending_follower_writes.json')}.{index}"
+    metrics_port = int(os.environ.get('METRICS_PORT', 9108))
+    if metrics_port:
+        os.environ['METRICS_PORT'] = str(metrics_port + index + 1)
+
+    import check_bot
+    check_bot.client.loop.run_until_complete(run_worker(check_bot, index, work_queue))
+
+
+async def run_worker(bot, index, work_queue):
+    logging.info(f"Starting worker {index}")
+    await bot.start_services()
+    await bot.start_client()
+    loop = asyncio.get_running_loop()
+    tasks = set()
+
+    def spawn(coro):
+        task = asyncio.create_task(coro)
+        tasks.add(task)
+        task.add_done_callback(tasks.discard)
+        task.add_done_callback(log_failure)
+
+    try:
+        while True:
+            item = await loop.run_in_executor(None, work_queue.get)
+            if item is None:
+                break
+            sender = item['sender']
+            if sender and sender.get('access_hash') is not None:
+                # Воркер не видел этого пользователя, передаем access_hash в его сессию
+                bot.client.session.process_entities([types.User(
+                    id=sender['id'],
+                    access_hash=sender['access_hash'],
+                    first_name=sender['first_name'],
+                    last_name=sender['last_name'],
+                    username=sender['username'],
+                )])
+            # Задачи создаются в порядке получения, а блокировка пользователя
+            # в обработчиках сохраняет этот порядок
+            if item['kind'] == 'callback':
+                spawn(bot.handle_callback_query(WorkerCallbackEvent(bot.client, item)))
+            else:
+                event = WorkerMessageEvent(bot.client, item)
+                if START_PATTERN.match(event.text or ''):
+                    spawn(bot.start(event))
+                spawn(bot.handle_all_messages(event))
+        await asyncio.gather(*tasks, return_exceptions=True)
+    finally:
+        await bot.stop_services()
+        await bot.client.disconnect()
+        logging.info(f"Worker {index} stopped")
+
+
+def log_failure(task):
+    if not task.cancelled() and task.exception() is not None:
+        logging.error(f"Handler failed in worker: {task.exception()!r}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the bot as one ingress process and N sharded workers")
+    parser.add_argument('--workers', type=int, default=int(os.environ.get('BOT_WORKERS', os.cpu_count() or 1)))
+    parser.add_argument('--queue-size', type=int, default=10000, help="max pending updates per worker")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=os.environ.get('LOG_LEVEL', 'INFO'), format='%(asctime)s - %(levelname)s - %(message)s')
+
+    context = multiprocessing.get_context('spawn')
+    queues = [context.Queue(maxsize=args.queue_size) for _ in range(args.workers)]
+    processes = [context.Process(target=worker_main, args=(i, args.workers, q), name=f'bot-worker-{i}')
+                 for i, q in enumerate(queues)]
+    for process in processes:
+        process.start()
+
+    try:
+        asyncio.run(run_ingress(queues))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for work_queue in queues:
+            work_queue.put(None)
+        for process in processes:
+            process.join(timeout=30)
+            if process.is_alive():
+                process.terminate()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,161 @@
+import abc
+import json
+import logging
+import sqlite3
+import time
+from collections import OrderedDict
+
+
+class StateStore(abc.ABC):
+    """Интерфейс хранилища состояния пользователей.
+
+    Состояние пользователя - это словарь (state, gender, news_index,
+    db_user_id и т.д.). get() всегда возвращает копию, изменения
+    сохраняются только через set()/update().
+    """
+
+    @abc.abstractmethod
+    def get(self, user_id):
+        pass
+
+    @abc.abstractmethod
+    def set(self, user_id, data):
+        pass
+
+    @abc.abstractmethod
+    def delete(self, user_id):
+        pass
+
+    @abc.abstractmethod
+    def __len__(self):
+        pass
+
+    def __contains__(self, user_id):
+        return bool(self.get(user_id))
+
+    def update(self, user_id, **fields):
+        data = self.get(user_id)
+        data.update(fields)
+        self.set(user_id, data)
+        return data
+
+    def close(self):
+        pass
+
+
+class MemoryStateStore(StateStore):
+    """Хранилище в памяти с вытеснением по LRU и TTL."""
+
+    def __init__(self, max_size=10000, ttl=None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._data = OrderedDict()
+
+    def _expired(self, saved_at):
+        return self.ttl is not None and time.monotonic() - saved_at >= self.ttl
+
+    def get(self, user_id):
+        entry = self._data.get(user_id)
+        if entry is None:
+            return {}
+        saved_at, data = entry
+        if self._expired(saved_at):
+            del self._data[user_id]
+            return {}
+        self._data.move_to_end(user_id)
+        return dict(data)
+
+    def set(self, user_id, data):
+        self._data[user_id] = (time.monotonic(), dict(data))
+        self._data.move_to_end(user_id)
+        while len(self._data) > self.max_size:
+            evicted_id, _ = self._data.popitem(last=False)
+            logging.debug(f"Evicted state for user_id {evicted_id}")
+
+    def delete(self, user_id):
+        self._data.pop(user_id, None)
+
+    def __len__(self):
+        return len(self._data)
+
+
+class SqliteStateStore(StateStore):
+    """Постоянное хранилище в SQLite (режим WAL).
+
+    Переживает перезапуск и может использоваться несколькими процессами
+    бота одновременно. При purge() удаляются записи старше ttl и самые
+    давние записи сверх max_size. Запросы выполняются прямо в цикле
+    событий, поэтому ожидание блокировки другого процесса ограничено
+    коротким busy_timeout.
+    """
+
+    PURGE_EVERY = 1000
+
+    def __init__(self, path, max_size=None, ttl=None, busy_timeout=0.25):
+        self.path = path
+        self.max_size = max_size
+        self.ttl = ttl
+        self._writes = 0
+        self._conn = sqlite3.connect(path, timeout=busy_timeout, isolation_level=None, check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.execute(
+            'CREATE TABLE IF NOT EXISTS user_state ('
+            'user_id INTEGER PRIMARY KEY, data TEXT NOT NULL, updated_at REAL NOT NULL)'
+        )
+        self._conn.execute('CREATE INDEX IF NOT EXISTS user_state_updated_at ON user_state (updated_at)')
+        self.purge()
+
+    def get(self, user_id):
+        row = self._conn.execute(
+            'SELECT data, updated_at FROM user_state WHERE user_id = ?', (user_id,)
+        ).fetchone()
+        if row is None:
+            return {}
+        data, updated_at = row
+        if self.ttl is not None and time.time() - updated_at >= self.ttl:
+            self.delete(user_id)
+            return {}
+        return json.loads(data)
+
+    def set(self, user_id, data):
+        self._conn.execute(
+            'INSERT INTO user_state (user_id, data, updated_at) VALUES (?, ?, ?) '
+            'ON CONFLICT(user_id) DO UPDATE SET data = excluded.data, updated_at = excluded.updated_at',
+            (user_id, json.dumps(data, ensure_ascii=False, default=str), time.time())
+        )
+        self._writes += 1
+        if self._writes % self.PURGE_EVERY == 0:
+            self.purge()
+
+    def delete(self, user_id):
+        self._conn.execute('DELETE FROM user_state WHERE user_id = ?', (user_id,))
+
+    def purge(self):
+        if self.ttl is not None:
+            cursor = self._conn.execute('DELETE FROM user_state WHERE updated_at < ?', (time.time() - self.ttl,))
+            if cursor.rowcount:
+                logging.info(f"Purged {cursor.rowcount} expired user states")
+        if self.max_size is not None:
+            # Оставляем max_size последних обновленных пользователей
+            cursor = self._conn.execute(
+                'DELETE FROM user_state WHERE user_id IN ('
+                'SELECT user_id FROM user_state ORDER BY updated_at DESC LIMIT -1 OFFSET ?)',
+                (self.max_size,)
+            )
+            if cursor.rowcount:
+                logging.info(f"Evicted {cursor.rowcount} least recently updated user states")
+
+    def __len__(self):
+        return self._conn.execute('SELECT COUNT(*) FROM user_state').fetchone()[0]
+
+    def close(self):
+        self._conn.close()
+
+
+def create_state_store(backend, path=None, max_size=10000, ttl=None, busy_timeout=0.25):
+    if backend == 'memory':
+        return MemoryStateStore(max_size=max_size, ttl=ttl)
+    if backend == 'sqlite':
+        return SqliteStateStore(path or 'bot_state.sqlite3', max_size=max_size, ttl=ttl, busy_timeout=busy_timeout)
+    raise ValueError(f"Unknown state store backend: {backend}")
@@ -0,0 +1,75 @@
+import asyncio
+import logging
+import random
+
+
+class TaskQueue:
+    """Ограниченная очередь фоновых задач с пулом воркеров и повторами.
+
+    Задача - это функция без аргументов, возвращающая корутину. При ошибке
+    она перезапускается до retries раз с экспоненциальной задержкой.
+    """
+
+    def __init__(self, name, workers=4, maxsize=1000, retries=3, backoff=1.0, max_backoff=30.0):
+        self.name = name
+        self.workers = workers
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self._queue = asyncio.Queue(maxsize=maxsize)
+        self._tasks = []
+
+    def start(self):
+        if self._tasks:
+            return
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+        logging.info(f"Task queue {self.name} started with {self.workers} workers")
+
+    async def stop(self, timeout=10):
+        """Дожидается выполнения поставленных задач и останавливает воркеры."""
+        if not self._tasks:
+            return
+        try:
+            await asyncio.wait_for(self._queue.join(), timeout)
+        except asyncio.TimeoutError:
+            logging.error(f"Task queue {self.name} stopped with {self._queue.qsize()} pending tasks")
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def submit(self, job, description=''):
+        """Ставит задачу в очередь. Возвращает False, если очередь переполнена."""
+        try:
+            self._queue.put_nowait((job, description))
+            return True
+        except asyncio.QueueFull:
+            logging.error(f"Task queue {self.name} is full, dropping task {description}")
+            return False
+
+    def qsize(self):
+        return self._queue.qsize()
+
+    async def _worker(self):
+        while True:
+            job, description = await self._queue.get()
+            try:
+                await self._run(job, description)
+            finally:
+                self._queue.task_done()
+
+    async def _run(self, job, description):
+        for attempt in range(self.retries + 1):
+            try:
+                await job()
+                return
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                if attempt == self.retries:
+                    logging.error(f"Task {description} in queue {self.name} failed after {attempt + 1} attempts: {e}")
+                    return
+                delay = min(self.max_backoff, self.backoff * 2 ** attempt)
+                delay *= random.uniform(0.5, 1.0)
+                logging.warning(f"Task {description} in queue {self.name} failed: {e}, retrying in {delay:.1f}s")
+                await asyncio.sleep(delay)
@@ -1,16 +1,22 @@
 from flask import Flask, request, jsonify
-import base64
+import os
+
+from deep_link import DeepLinks
+
+DEEP_LINK_SECRET = os.environ['DEEP_LINK_SECRET']  # Общий с ботом ключ подписи
+CAMPAIGNS_DB_PATH = os.environ.get('CAMPAIGNS_DB_PATH', 'campaigns.sqlite3')
 
 app = Flask(__name__)
+deep_links = DeepLinks(DEEP_LINK_SECRET, CAMPAIGNS_DB_PATH)
 
 @app.route('/generate_link', methods=['GET'])
 def generate_link():
     utm_source = request.args.get('utm_source')
     utm_medium = request.args.get('utm_medium')
+    utm_campaign = request.args.get('utm_campaign', 'unknown')
     if not utm_source or not utm_medium:
         return jsonify({"error": "Both utm_source and utm_medium are required"}), 400
-    params = f"utm_source={utm_source}&utm_medium={utm_medium}"
-    encoded_params = base64.urlsafe_b64encode(params.encode()).decode().rstrip('=')
+    encoded_params = deep_links.make_payload(utm_source, utm_medium, utm_campaign)
     generated_link = f"https://t.me/producore_bot?start={encoded_params}"
     return jsonify({"generated_link": generated_link})
 
@@ -0,0 +1,143 @@
+import asyncio
+import json
+import logging
+import os
+import random
+import time
+
+
+class WriteBehindQueue:
+    """Отложенная запись обновлений с объединением по ключу.
+
+    Несколько обновлений одного ключа (db_user_id) сливаются в одну запись,
+    которая отправляется через flush_func(key, fields) при накоплении
+    max_batch ключей или раз в flush_interval секунд. Неудачные записи
+    повторяются с экспоненциальной задержкой, а при остановке все
+    неотправленное сохраняется в persist_path и подхватывается при запуске.
+    """
+
+    def __init__(self, name, flush_func, max_batch=100, flush_interval=2.0, concurrency=10,
+                 retries=5, backoff=1.0, max_backoff=60.0, persist_path=None, transient_errors=()):
+        self.name = name
+        self.flush_func = flush_func
+        self.max_batch = max_batch
+        self.flush_interval = flush_interval
+        self.concurrency = concurrency
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.persist_path = persist_path
+        # Ошибки, при которых запись откладывается, но попытка не засчитывается
+        self.transient_errors = tuple(transient_errors)
+        # key -> {'fields': dict, 'attempts': int, 'not_before': float}
+        self._pending = {}
+        self._wakeup = asyncio.Event()
+        self._stopping = False
+        self._task = None
+
+    def enqueue(self, key, fields):
+        entry = self._pending.setdefault(key, {'fields': {}, 'attempts': 0, 'not_before': 0.0})
+        entry['fields'].update(fields)
+        if len(self._pending) >= self.max_batch:
+            self._wakeup.set()
+
+    def __len__(self):
+        return len(self._pending)
+
+    def start(self):
+        if self._task is not None:
+            return
+        self._load()
+        self._stopping = False
+        self._task = asyncio.create_task(self._run())
+        logging.info(f"Write-behind queue {self.name} started with {len(self._pending)} pending writes")
+
+    async def stop(self):
+        if self._task is None:
+            return
+        # Не отменяем задачу: начатая отправка должна закончиться, иначе записи потеряются
+        self._stopping = True
+        self._wakeup.set()
+        await asyncio.gather(self._task, return_exceptions=True)
+        self._task = None
+        try:
+            # Последняя попытка отправить все, что накопилось, без учета задержек
+            await self.flush(force=True)
+        finally:
+            self._save()
+
+    async def flush(self, force=False):
+        now = time.monotonic()
+        ready = [key for key, entry in self._pending.items() if force or entry['not_before'] <= now]
+        if not ready:
+            return
+        batch = {key: self._pending.pop(key) for key in ready}
+        semaphore = asyncio.Semaphore(self.concurrency)
+
+        async def write(key, entry):
+            async with semaphore:
+                try:
+                    await self.flush_func(key, entry['fields'])
+                except asyncio.CancelledError:
+                    # Запись прервана: возвращаем ее в очередь без учета попытки
+                    self._restore(key, entry, entry['attempts'], 0.0)
+                    raise
+                except Exception as e:
+                    self._requeue(key, entry, e)
+
+        await asyncio.gather(*(write(key, entry) for key, entry in batch.items()))
+
+    def _requeue(self, key, entry, error):
+        attempts = entry['attempts'] if isinstance(error, self.transient_errors) else entry['attempts'] + 1
+        if attempts > self.retries:
+            logging.error(f"Dropping write for {key} in queue {self.name} after {attempts} attempts: {error}")
+            return
+        delay = min(self.max_backoff, self.backoff * 2 ** max(0, attempts - 1)) * random.uniform(0.5, 1.0)
+        logging.warning(f"Write for {key} in queue {self.name} failed: {error}, retrying in {delay:.1f}s")
+        self._restore(key, entry, attempts, time.monotonic() + delay)
+
+    def _restore(self, key, entry, attempts, not_before):
+        # Поля, поставленные в очередь во время записи, новее неудачных
+        newer = self._pending.get(key)
+        fields = dict(entry['fields'])
+        if newer:
+            fields.update(newer['fields'])
+        self._pending[key] = {'fields': fields, 'attempts': attempts, 'not_before': not_before}
+
+    async def _run(self):
+        while not self._stopping:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            if self._stopping:
+                break
+            try:
+                await self.flush()
+            except Exception as e:
+                logging.error(f"Write-behind queue {self.name} flush failed: {e}")
+
+    def _load(self):
+        if not self.persist_path or not os.path.exists(self.persist_path):
+            return
+        try:
+            with open(self.persist_path, encoding='utf-8') as f:
+                saved = json.load(f)
+        except (OSError, ValueError) as e:
+            logging.error(f"Failed to load pending writes from {self.persist_path}: {e}")
+            return
+        for key, fields in saved:
+            self.enqueue(key, fields)
+        os.unlink(self.persist_path)
+
+    def _save(self):
+        if not self._pending:
+            return
+        if not self.persist_path:
+            logging.error(f"Write-behind queue {self.name} lost {len(self._pending)} pending writes on shutdown")
+            return
+        saved = [[key, entry['fields']] for key, entry in self._pending.items()]
+        with open(self.persist_path, 'w', encoding='utf-8') as f:
+            json.dump(saved, f, ensure_ascii=False)
+        logging.info(f"Saved {len(saved)} pending writes to {self.persist_path}")